@@ -0,0 +1,150 @@
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+from time import perf_counter
+
+# Mixed read/write traffic from several processes (like gunicorn workers) against one
+# SQLite file, once with SQLite's defaults (rollback journal, synchronous=FULL) and once
+# with the SQLITE_PRAGMAS the app now sets (WAL, synchronous=NORMAL, busy_timeout).
+#
+#   python bench_concurrency.py
+#   python bench_concurrency.py --workers 8 --seconds 20
+#   BENCH_WRITE_RATIO=0.7 python bench_concurrency.py
+
+BENCH_DIR = tempfile.gettempdir()
+SEED_DB = os.path.join(BENCH_DIR, 'bench_concurrency_seed.db')
+PRODUCTS = 2000
+USERS = 50
+WRITE_RATIO = float(os.environ.get('BENCH_WRITE_RATIO', 0.3))  # carts and checkouts write, browsing reads
+
+CONFIGS = [
+    ("rollback journal, synchronous=FULL", {'SQLITE_JOURNAL_MODE': 'DELETE', 'SQLITE_SYNCHRONOUS': 'FULL'}),
+    ("WAL, synchronous=NORMAL", {'SQLITE_JOURNAL_MODE': 'WAL', 'SQLITE_SYNCHRONOUS': 'NORMAL'}),
+]
+WORDS = ['red', 'blue', 'leather', 'cotton', 'wireless', 'vintage', 'ceramic', 'running',
+         'shoe', 'jacket', 'mug', 'lamp', 'headphones', 'watch', 'bag', 'wallet']
+
+def worker_env(db_path, extra):
+    env = dict(os.environ, DB_URI=f"sqlite:///{db_path}", MAIL_WORKERS='0', INVOICE_PROCESSES='0',
+               UPLOAD_WORKERS='0', SEARCH_FLUSH_SECONDS='0.5')
+    env.update(extra)
+    return env
+
+def seed():
+    if os.path.exists(SEED_DB):
+        os.remove(SEED_DB)
+    env = worker_env(SEED_DB, {'SQLITE_JOURNAL_MODE': 'DELETE'})
+    subprocess.run([sys.executable, __file__, '--seed'], env=env, check=True)
+
+def run_seed():
+    from server import app, db, Product, User, migrate_database
+    with app.app_context():
+        migrate_database()
+        db.session.execute(db.insert(User), [
+            {'name': f'User {i}', 'email': f'user{i}@example.com', 'password': 'x'} for i in range(USERS)
+        ])
+        db.session.execute(db.insert(Product), [
+            {'title': ' '.join(random.sample(WORDS, 3)).title() + f' #{i}', 'price': random.randint(100, 50000),
+             'description': ' '.join(random.choices(WORDS, k=20)), 'image_url': 'https://example.com/p.jpg'}
+            for i in range(PRODUCTS)
+        ])
+        db.session.commit()
+
+def run_worker(seconds):
+    from server import app, db, cart_store, Product, Order, OrderItem
+    client = app.test_client()
+    reads = writes = errors = 0
+    latencies = []
+    deadline = perf_counter() + seconds
+    while perf_counter() < deadline:
+        start = perf_counter()
+        try:
+            roll = random.random()
+            if roll < WRITE_RATIO / 2:
+                # Add to cart (the /api/cart/items upsert)
+                with app.app_context():
+                    cart_store.add(random.randint(1, USERS), random.randint(1, PRODUCTS))
+                    db.session.commit()
+                writes += 1
+            elif roll < WRITE_RATIO:
+                # Checkout like /checkout: read the cart's products, then write the order
+                # and its lines in the same transaction (no emails or PDF)
+                with app.app_context():
+                    products = db.session.execute(
+                        db.select(Product).where(Product.id.in_(random.sample(range(1, PRODUCTS + 1), 2)))
+                    ).scalars().all()
+                    order = Order(user_id=random.randint(1, USERS), total_price=sum(p.price for p in products))
+                    db.session.add(order)
+                    db.session.flush()
+                    db.session.execute(db.insert(OrderItem), [
+                        {'order_id': order.id, 'product_id': p.id, 'quantity': 1, 'price_at_purchase': p.price}
+                        for p in products
+                    ])
+                    db.session.commit()
+                writes += 1
+            else:
+                if random.random() < 0.5:
+                    # Search page (also feeds the search-term buffer, flushed in the background)
+                    response = client.get(f"/?q={random.choice(WORDS)}&page={random.randint(1, 5)}")
+                else:
+                    response = client.get(f"/product/{random.randint(1, PRODUCTS)}")
+                if response.status_code >= 500:
+                    raise RuntimeError(response.status_code)
+                reads += 1
+            latencies.append(perf_counter() - start)
+        except Exception:
+            errors += 1  # typically "database is locked"
+    print(json.dumps({'reads': reads, 'writes': writes, 'errors': errors, 'latencies': latencies}))
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else 0
+
+def run_benchmark(workers, seconds):
+    print(f"Seeding {PRODUCTS} products and {USERS} users...")
+    seed()
+    print(f"{workers} worker processes, {seconds}s each config, {WRITE_RATIO:.0%} writes\n")
+    print(f"{'config':<38}{'req/s':>9}{'writes/s':>10}{'errors':>8}{'p50 ms':>9}{'p95 ms':>9}")
+
+    for label, pragmas in CONFIGS:
+        db_path = os.path.join(BENCH_DIR, 'bench_concurrency.db')
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(db_path + suffix):
+                os.remove(db_path + suffix)
+        shutil.copy(SEED_DB, db_path)
+
+        env = worker_env(db_path, pragmas)
+        procs = [
+            subprocess.Popen([sys.executable, __file__, '--worker', str(seconds)], env=env, stdout=subprocess.PIPE, text=True)
+            for _ in range(workers)
+        ]
+        results = [json.loads(proc.communicate()[0].strip().splitlines()[-1]) for proc in procs]
+
+        reads = sum(r['reads'] for r in results)
+        writes = sum(r['writes'] for r in results)
+        errors = sum(r['errors'] for r in results)
+        latencies = [value for r in results for value in r['latencies']]
+        print(f"{label:<38}{(reads + writes) / seconds:>9.0f}{writes / seconds:>10.0f}{errors:>8}"
+              f"{percentile(latencies, 0.5) * 1000:>9.1f}{percentile(latencies, 0.95) * 1000:>9.1f}")
+
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(db_path + suffix):
+                os.remove(db_path + suffix)
+    os.remove(SEED_DB)
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ['--seed']:
+        run_seed()
+    elif sys.argv[1:2] == ['--worker']:
+        run_worker(float(sys.argv[2]))
+    else:
+        import argparse
+        parser = argparse.ArgumentParser(description="Mixed read/write throughput with and without the SQLite tuning.")
+        parser.add_argument('--workers', type=int, default=4)
+        parser.add_argument('--seconds', type=float, default=10)
+        args = parser.parse_args()
+        run_benchmark(args.workers, args.seconds)
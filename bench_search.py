@@ -0,0 +1,70 @@
+import os
+import random
+import tempfile
+from time import perf_counter
+
+# Point the app at a throwaway database BEFORE importing it
+BENCH_DB = os.path.join(tempfile.gettempdir(), 'bench_search.db')
+if os.path.exists(BENCH_DB):
+    os.remove(BENCH_DB)
+os.environ['DB_URI'] = f"sqlite:///{BENCH_DB}"
+
+from server import app, db, Product, search_products, current_search_backend, migrate_database
+
+CATALOG_SIZE = 100_000
+RUNS = 20
+QUERIES = ['shoe', 'red leather', 'ceramic mug', 'vintage', 'wireless headphones', 'zzznothing']
+
+WORDS = ['red', 'blue', 'green', 'leather', 'cotton', 'wireless', 'vintage', 'classic', 'ceramic',
+         'running', 'shoe', 'jacket', 'mug', 'lamp', 'headphones', 'watch', 'bag', 'wallet', 'desk', 'chair']
+# Real descriptions are mostly long-tail words, so give the generator a big vocabulary too
+FILLER = [''.join(random.choices('abcdefghijklmnopqrstuvwxyz', k=random.randint(4, 9))) for _ in range(20_000)]
+
+def seed_catalog():
+    print(f"Seeding {CATALOG_SIZE} products...")
+    rows = []
+    for i in range(CATALOG_SIZE):
+        rows.append({
+            'title': ' '.join(random.sample(WORDS, 2) + random.sample(FILLER, 1)).title() + f" #{i}",
+            'price': random.randint(100, 50000),
+            'description': ' '.join(random.choices(FILLER, k=22) + random.sample(WORDS, 1)),
+            'image_url': 'https://example.com/placeholder.jpg',
+        })
+    start = perf_counter()
+    db.session.execute(db.insert(Product), rows)
+    db.session.commit()
+    print(f"Seeded in {perf_counter() - start:.1f}s")
+
+def time_query(build_stmt):
+    start = perf_counter()
+    for _ in range(RUNS):
+        pagination = db.paginate(build_stmt(), page=1, per_page=12, error_out=False)
+        pagination.items
+    return (perf_counter() - start) / RUNS * 1000
+
+def run_benchmark():
+    with app.app_context():
+        migrate_database()
+        seed_catalog()
+        print(f"\nSearch backend: {current_search_backend()}  ({RUNS} runs per query, first page of 12)\n")
+        print(f"{'query':<24}{'LIKE (ms)':>12}{'indexed (ms)':>15}{'speedup':>10}")
+
+        for query in QUERIES:
+            def like_stmt():
+                like = f'%{query}%'
+                return db.select(Product).where(
+                    Product.title.like(like) | Product.description.like(like)
+                ).order_by(Product.title)
+
+            def indexed_stmt():
+                stmt, rank = search_products(db.select(Product), query)
+                return stmt.order_by(rank, Product.id) if rank is not None else stmt.order_by(Product.title)
+
+            like_ms = time_query(like_stmt)
+            indexed_ms = time_query(indexed_stmt)
+            print(f"{query:<24}{like_ms:>12.2f}{indexed_ms:>15.2f}{like_ms / indexed_ms:>9.1f}x")
+
+    os.remove(BENCH_DB)
+
+if __name__ == "__main__":
+    run_benchmark()
@@ -1,57 +1,312 @@
-import sqlite3
-import psycopg2
+import argparse
+import csv
+import hashlib
+import io
 import os
+import subprocess
+import sys
+from datetime import date, datetime
+from time import perf_counter
+
 from dotenv import load_dotenv
+from sqlalchemy import create_engine, MetaData, Table, Column, String, Integer, Boolean, select, insert, update
 
 load_dotenv()
 
-SQLITE_PATH = 'instance/Product.db' 
-NEON_PG_URL = os.environ.get("NEON_POSTGRES_DB_URL")
+SOURCE_URL = os.environ.get("SOURCE_DB_URL", "sqlite:///instance/Product.db")
+TARGET_URL = os.environ.get("NEON_POSTGRES_DB_URL")
+BATCH_SIZE = 5000
+
+# Owned by `flask upgrade-db` on the target: the FTS index and its bookkeeping
+# (schema_migrations, catalog_version) must describe the TARGET, and daily_sales is
+# a rollup rebuilt from the copied orders
+SKIP_PREFIXES = ('sqlite_', 'product_fts')
+SKIP_TABLES = ('schema_migrations', 'catalog_version', 'daily_sales')
+CHECKPOINT_TABLE = '_migration_checkpoint'
+NULL_MARKER = '\\N'
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+# Derived data the copy can't carry: rows go in with Core inserts, so the app's ORM
+# listeners never keep product ratings in step (and an old source has no aggregates)
+REBUILD_COMMANDS = ['backfill-ratings', 'rebuild-daily-sales']
+
+# Copies EVERY table, in foreign key order, keeping the primary keys (so order items,
+# reviews, images and wishlists still point at the right rows). Each batch is committed
+# together with a checkpoint row in the target, so an interrupted run picks up exactly
+# where it stopped. At the end, Postgres sequences are moved past the copied ids and
+# every table is compared by row count and checksum, and the app's own commands
+# recompute the rating aggregates and the daily_sales rollup on the target.
+# The target needs the app's schema first: run `flask upgrade-db` against it.
+#
+#   DB_URI=postgresql://... flask --app server upgrade-db
+#   python migrate_data.py                      (source: SOURCE_DB_URL, target: NEON_POSTGRES_DB_URL)
+#   python migrate_data.py --source sqlite:///instance/Product.db --target postgresql://...
+#   python migrate_data.py --verify-only
+#   python migrate_data.py --restart            (forget the checkpoints, target tables must be empty)
+
+def checkpoint_table(metadata):
+    return Table(
+        CHECKPOINT_TABLE, metadata,
+        Column('table_name', String(100), primary_key=True),
+        Column('last_key', Integer),       # highest primary key copied so far (single integer pk)
+        Column('rows_copied', Integer, nullable=False, default=0),
+        Column('done', Boolean, nullable=False, default=False),
+    )
+
+def skipped(name):
+    return name.startswith(SKIP_PREFIXES) or name in SKIP_TABLES
+
+class SchemaError(Exception):
+    pass
+
+def copy_tables(source, target):
+    """Source tables in dependency order, and the matching target tables."""
+    source_meta = MetaData()
+    source_meta.reflect(bind=source)
+    tables = [t for t in source_meta.sorted_tables if not skipped(t.name) and t.name != CHECKPOINT_TABLE]
+
+    target_meta = MetaData()
+    target_meta.reflect(bind=target)
+    if 'schema_migrations' not in target_meta.tables:
+        raise SchemaError("the target has no schema yet. Run `flask upgrade-db` against it first.")
+    missing = [table.name for table in tables if table.name not in target_meta.tables]
+    if missing:
+        raise SchemaError(f"tables missing in the target: {', '.join(missing)}. Is `flask upgrade-db` up to date there?")
+    checkpoints = checkpoint_table(target_meta) if CHECKPOINT_TABLE not in target_meta.tables else target_meta.tables[CHECKPOINT_TABLE]
+    checkpoints.create(bind=target, checkfirst=True)
+    return [(table, target_meta.tables[table.name]) for table in tables], checkpoints
+
+def integer_pk(table):
+    pk = list(table.primary_key.columns)
+    if len(pk) == 1 and pk[0].type.python_type is int:
+        return pk[0]
+    return None
+
+def temporal_parser(kind):
+    def parse(value):
+        if not isinstance(value, str):
+            return value
+        parsed = datetime.fromisoformat(value)
+        return parsed if kind is datetime else parsed.date()
+    return parse
+
+def column_parsers(target_table, columns):
+    """One function per column turning source values into what the target column takes.
+
+    The original SQLite schema declared order.date, review.date_posted and
+    search_term.last_searched as VARCHAR(20) holding '2026-01-06 00:00:00.000000',
+    while the app's schema (and Postgres) have real DATETIME columns.
+    """
+    parsers = []
+    for name in columns:
+        try:
+            kind = target_table.c[name].type.python_type
+        except NotImplementedError:
+            kind = None
+        parsers.append(temporal_parser(kind) if kind in (datetime, date) else None)
+    return parsers
+
+def parse_row(row, parsers):
+    return tuple(parse(value) if parse else value for value, parse in zip(row, parsers))
+
+def to_copy_value(value):
+    if value is None:
+        return NULL_MARKER
+    if isinstance(value, bytes):
+        return '\\x' + value.hex()  # bytea hex input format
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return value
+
+def write_batch(target_conn, target_table, columns, rows):
+    if target_conn.dialect.name == 'postgresql':
+        # COPY is an order of magnitude faster than INSERTs on Postgres
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows([to_copy_value(value) for value in row] for row in rows)
+        buffer.seek(0)
+        column_list = ', '.join(f'"{name}"' for name in columns)
+        cursor = target_conn.connection.cursor()
+        cursor.copy_expert(
+            f'COPY "{target_table.name}" ({column_list}) FROM STDIN WITH (FORMAT csv, NULL \'{NULL_MARKER}\')', buffer
+        )
+    else:
+        target_conn.execute(insert(target_table), [dict(zip(columns, row)) for row in rows])
+
+def copy_table(source, target, source_table, target_table, checkpoints, batch_size):
+    with target.connect() as conn:
+        state = conn.execute(select(checkpoints).where(checkpoints.c.table_name == source_table.name)).first()
+    if state is None:
+        with target.begin() as conn:
+            conn.execute(insert(checkpoints).values(table_name=source_table.name, rows_copied=0, done=False))
+        last_key, copied = None, 0
+    elif state.done:
+        print(f"⏭️  {source_table.name}: already copied ({state.rows_copied:,} rows)")
+        return
+    else:
+        last_key, copied = state.last_key, state.rows_copied
+        print(f"↩️  {source_table.name}: resuming after {copied:,} rows")
+
+    # Only the columns both sides have (the target may be newer than the source)
+    columns = [c.name for c in source_table.columns if c.name in target_table.columns]
+    parsers = column_parsers(target_table, columns)
+    pk = integer_pk(source_table)
+    start = perf_counter()
+
+    while True:
+        stmt = select(*[source_table.c[name] for name in columns])
+        if pk is not None:
+            # Keyset paging: each batch is an index range scan, however deep we are
+            stmt = stmt.order_by(pk).limit(batch_size)
+            if last_key is not None:
+                stmt = stmt.where(pk > last_key)
+        else:
+            # Link tables without a single integer key (e.g. wishlist): page by position
+            stmt = stmt.order_by(*[source_table.c[name] for name in columns]).offset(copied).limit(batch_size)
+        with source.connect() as conn:
+            rows = conn.execute(stmt).all()
+        if not rows:
+            break
+
+        # The rows and the checkpoint commit together, or not at all
+        with target.begin() as conn:
+            write_batch(conn, target_table, columns, [parse_row(row, parsers) for row in rows])
+            copied += len(rows)
+            if pk is not None:
+                last_key = rows[-1][columns.index(pk.name)]
+            conn.execute(
+                update(checkpoints).where(checkpoints.c.table_name == source_table.name)
+                .values(last_key=last_key, rows_copied=copied)
+            )
+        elapsed = perf_counter() - start
+        print(f"   {source_table.name}: {copied:,} rows ({copied / max(elapsed, 1e-9):,.0f} rows/sec)")
+
+    with target.begin() as conn:
+        conn.execute(update(checkpoints).where(checkpoints.c.table_name == source_table.name).values(done=True))
+    print(f"✅ {source_table.name}: {copied:,} rows")
+
+def reset_sequences(target, tables):
+    """Explicit ids don't advance SERIAL sequences; move each one past the highest copied id."""
+    if target.dialect.name != 'postgresql':
+        return
+    with target.begin() as conn:
+        for _, target_table in tables:
+            pk = integer_pk(target_table)
+            if pk is None:
+                continue
+            sequence = conn.exec_driver_sql(
+                f"SELECT pg_get_serial_sequence('\"{target_table.name}\"', '{pk.name}')"
+            ).scalar()
+            if sequence:
+                conn.exec_driver_sql(
+                    f"SELECT setval('{sequence}', COALESCE(MAX(\"{pk.name}\"), 1), MAX(\"{pk.name}\") IS NOT NULL) "
+                    f"FROM \"{target_table.name}\""
+                )
+    print("🔢 Sequences reset.")
+
+def normalize(value):
+    # Both engines must hash a row identically: SQLite hands back 0/1 and text
+    # where Postgres has booleans and real timestamps
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return str(int(value))
+    if isinstance(value, bytes):
+        return value.hex()
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, float):
+        return repr(round(value, 6))
+    return str(value)
+
+def table_checksum(engine, table, columns, batch_size, parsers):
+    """Row count plus an order-independent checksum (sum of per-row hashes)."""
+    count, total = 0, 0
+    with engine.connect() as conn:
+        result = conn.execution_options(stream_results=True).execute(
+            select(*[table.c[name] for name in columns])
+        )
+        for partition in result.partitions(batch_size):
+            for row in partition:
+                # Parsed the same way as when copying, so text and real timestamps hash alike
+                row = parse_row(row, parsers)
+                digest = hashlib.md5('\x1f'.join(normalize(v) for v in row).encode()).digest()
+                total = (total + int.from_bytes(digest[:8], 'big')) % (1 << 64)
+                count += 1
+    return count, total
+
+def verify(source, target, tables, batch_size):
+    print("\nVerifying...")
+    mismatches = 0
+    for source_table, target_table in tables:
+        columns = [c.name for c in source_table.columns if c.name in target_table.columns]
+        parsers = column_parsers(target_table, columns)
+        source_count, source_sum = table_checksum(source, source_table, columns, batch_size, parsers)
+        target_count, target_sum = table_checksum(target, target_table, columns, batch_size, parsers)
+        if (source_count, source_sum) == (target_count, target_sum):
+            print(f"   ✅ {source_table.name}: {source_count:,} rows, checksum {source_sum:016x}")
+        else:
+            mismatches += 1
+            print(f"   ❌ {source_table.name}: source {source_count:,} rows / {source_sum:016x}, "
+                  f"target {target_count:,} rows / {target_sum:016x}")
+    return mismatches == 0
+
+def rebuild_derived_data(target_url):
+    """Run the app's repair commands against the target (they also bump the catalog version)."""
+    env = dict(os.environ, DB_URI=target_url, MAIL_WORKERS='0', UPLOAD_WORKERS='0')
+    for command in REBUILD_COMMANDS:
+        print(f"🔁 flask {command}...")
+        result = subprocess.run([sys.executable, '-m', 'flask', '--app', 'server', command], env=env, cwd=APP_DIR)
+        if result.returncode != 0:
+            print(f"❌ ERROR: `flask {command}` failed, run it against the target by hand.")
+            return False
+    return True
 
 def run_migration():
+    parser = argparse.ArgumentParser(description="Copy every table from SQLite to Postgres, resumably.")
+    parser.add_argument('--source', default=SOURCE_URL, help='SQLAlchemy URL of the database to copy from.')
+    parser.add_argument('--target', default=TARGET_URL, help='SQLAlchemy URL of the database to copy into.')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='Rows per COPY/transaction.')
+    parser.add_argument('--verify-only', action='store_true', help='Only compare row counts and checksums.')
+    parser.add_argument('--restart', action='store_true', help='Forget saved checkpoints and start over.')
+    args = parser.parse_args()
+
+    if not args.target:
+        print("❌ ERROR: no target database. Set NEON_POSTGRES_DB_URL or pass --target.")
+        return 1
+    # Render/Heroku style URLs still say postgres://
+    target_url = args.target.replace('postgres://', 'postgresql://', 1)
+
     print("Connecting to databases...")
-    
+    source = create_engine(args.source)
+    target = create_engine(target_url)
+    start = perf_counter()
     try:
-        # Open local connection
-        sqlite_conn = sqlite3.connect(SQLITE_PATH)
-        sqlite_cursor = sqlite_conn.cursor()
-        
-        # Open remote connection
-        pg_conn = psycopg2.connect(NEON_PG_URL)
-        pg_cursor = pg_conn.cursor()
-        
-        print("Extracting products from local SQLite...")
-        # We only grab the core data, letting Postgres generate new IDs to avoid sequence errors
-        sqlite_cursor.execute("SELECT title, price, description, image_url FROM product")
-        products = sqlite_cursor.fetchall()
-        
-        if not products:
-            print("No products found in the local database. Check your SQLITE_PATH.")
-            return
-
-        print(f"Found {len(products)} products. Loading into Render...")
-        
-        # Insert each product into the cloud database
-        for product in products:
-            pg_cursor.execute(
-                """
-                INSERT INTO product (title, price, description, image_url) 
-                VALUES (%s, %s, %s, %s)
-                """,
-                (product[0], product[1], product[2], product[3])
-            )
-            
-        # Commit the transaction to save the data permanently
-        pg_conn.commit()
-        print(f"✅ SUCCESS: {len(products)} products successfully migrated to the cloud!")
-
-    except Exception as e:
-        print(f"❌ ERROR: {e}")
-        
+        try:
+            tables, checkpoints = copy_tables(source, target)
+        except SchemaError as e:
+            print(f"❌ ERROR: {e}")
+            return 1
+
+        if not args.verify_only:
+            if args.restart:
+                with target.begin() as conn:
+                    conn.execute(checkpoints.delete())
+            for source_table, target_table in tables:
+                copy_table(source, target, source_table, target_table, checkpoints, args.batch_size)
+            reset_sequences(target, tables)
+
+        ok = verify(source, target, tables, args.batch_size)
     finally:
-        # Always close your connections
-        if 'sqlite_conn' in locals(): sqlite_conn.close()
-        if 'pg_conn' in locals(): pg_conn.close()
+        source.dispose()
+        target.dispose()
+
+    if not ok:
+        print("❌ Verification failed, see the tables above.")
+        return 1
+    # After verifying: the recomputed columns may differ from a source that predates them
+    if not args.verify_only and not rebuild_derived_data(target_url):
+        return 1
+    print(f"\n✅ SUCCESS: {len(tables)} tables migrated and verified in {perf_counter() - start:.1f}s")
+    return 0
 
 if __name__ == "__main__":
-    run_migration()
+    raise SystemExit(run_migration())
@@ -1,35 +1,59 @@
 import csv
 import io
 import re
+import zlib
+import sys
+import hashlib
+import sqlite3
 from xhtml2pdf import pisa
 from io import BytesIO
-from sqlalchemy import func, text
+from sqlalchemy import func, text, event, inspect, literal_column, table, column, cast, case
 import json
-from time import sleep
-from flask import make_response
-from datetime import datetime
-from flask import Flask,render_template,request,session,url_for,redirect,flash,get_flashed_messages,abort
+from time import sleep, time, time_ns, perf_counter
+from flask import make_response, send_file, send_from_directory, Response, stream_with_context
+from datetime import datetime, timedelta, timezone
+from flask import Flask,render_template,request,session,url_for,redirect,flash,get_flashed_messages,abort,g,has_request_context,jsonify
 from flask import Flask
 from email_validator import validate_email, EmailNotValidError
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.orm import DeclarativeBase
+from sqlalchemy.orm import DeclarativeBase, Session, selectinload, joinedload, raiseload
+from sqlalchemy.engine import Engine
+from sqlalchemy.sql import Select
+from sqlalchemy.sql.dml import UpdateBase
+from flask_sqlalchemy.session import Session as BaseSession
 from sqlalchemy import Integer, String
 from sqlalchemy.orm import Mapped, mapped_column
 from flask_wtf import FlaskForm
 from wtforms.fields import StringField, IntegerField, SubmitField, FloatField
-from wtforms.validators import DataRequired, URL, Optional, Email, ValidationError, Length
-from wtforms import PasswordField, EmailField, TextAreaField, SelectField
+from wtforms.validators import DataRequired, URL, Optional, Email, ValidationError, Length, NumberRange
+from wtforms import PasswordField, EmailField, TextAreaField, SelectField, HiddenField
 from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.http import is_resource_modified
 from flask_login import UserMixin, login_user, LoginManager, login_required, current_user, logout_user
 from functools import wraps
+import click
 import os
 from dotenv import load_dotenv
 import cloudinary
 import cloudinary.uploader
+from PIL import Image, ImageDraw, ImageFont, ImageOps, UnidentifiedImageError
+from uuid import uuid4
 from flask_wtf.file import FileField, FileAllowed, FileRequired
+from flask_wtf.csrf import generate_csrf, validate_csrf
 from flask_mail import Mail, Message
+try:
+    import redis
+except ImportError:  # optional: only needed when REDIS_URL is set
+    redis = None
 from itsdangerous import URLSafeTimedSerializer, SignatureExpired
-from threading import Thread
+from threading import Thread, Lock, Event
+from queue import Queue
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, Future
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+import atexit
+from sqlalchemy.dialects import sqlite, postgresql
 
 load_dotenv()
 
@@ -122,6 +146,10 @@ class AddProductForm(FlaskForm):
     # Note: User enters dollars (e.g., 10.50), we will convert to cents later
     price = FloatField('Price (e.g., 10.99)', validators=[DataRequired()]) 
     description = StringField('Description', validators=[DataRequired()])
+    # Blank = unlimited (every product from before stock tracking)
+    stock = IntegerField('Stock', validators=[Optional(), NumberRange(min=0)])
+    # Edit form only: the stock the admin saw, so a save can't undo sales made meanwhile
+    original_stock = HiddenField()
     image_url = StringField('Image URL', validators=[URL(),Optional()])
     image_file = FileField('OR Upload Image', validators=[
         FileAllowed(['jpg', 'png', 'jpeg'], 'Images only!'),
@@ -145,19 +173,129 @@ cloudinary.config(
 class Base(DeclarativeBase):
   pass
 
-db = SQLAlchemy(model_class=Base)
+class RoutingSession(BaseSession):
+    """SELECTs of @read_replica views go to the replica bind, everything else to the primary."""
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and has_request_context() and 'replica' in self._db.engines:
+            if self._flushing or isinstance(clause, UpdateBase):
+                # From here on this request (and, see stick_to_primary, this visitor) reads its own writes
+                g.wrote_primary = True
+            elif isinstance(clause, Select) and g.get('use_replica') and not g.get('wrote_primary'):
+                return self._db.engines['replica']
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+db = SQLAlchemy(model_class=Base, session_options={'class_': RoutingSession})
 
 app=Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get("SECRET_KEY",'8BYkEfBA6O6donzWlSihBXox7C0sKR6b')
 app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DB_URI","sqlite:///Product.db")
-
-app.config['MAIL_SERVER'] = 'smtp.gmail.com'
-app.config['MAIL_PORT'] = 587
-app.config['MAIL_USE_TLS'] = True
+# Shared cache for counters/versions across gunicorn workers (falls back to per-worker memory)
+app.config['REDIS_URL'] = os.environ.get('REDIS_URL')
+# Where carts live: 'db' (cart_item table), 'redis' (needs REDIS_URL) or 'memory' (tests/dev)
+app.config['CART_BACKEND'] = os.environ.get('CART_BACKEND', 'db')
+# Strict mode (for tests/dev): lazy loads on eager-loaded pages raise, and query budgets fail loudly
+app.config['STRICT_QUERIES'] = os.environ.get('STRICT_QUERIES') == '1'
+
+app.config['MAIL_SERVER'] = os.environ.get('MAIL_SERVER', 'smtp.gmail.com')
+app.config['MAIL_PORT'] = int(os.environ.get('MAIL_PORT', 587))
+app.config['MAIL_USE_TLS'] = os.environ.get('MAIL_USE_TLS', '1') == '1'
 app.config['MAIL_USERNAME'] = os.environ.get('EMAIL_USER')
 app.config['MAIL_PASSWORD'] = os.environ.get('EMAIL_PASS')
+# Outbox: how many sender threads per web worker (0 = leave it all to 'flask outbox-worker')
+app.config['MAIL_WORKERS'] = int(os.environ.get('MAIL_WORKERS', 2))
+app.config['MAIL_MAX_ATTEMPTS'] = int(os.environ.get('MAIL_MAX_ATTEMPTS', 5))
+
+
+# --- DATABASE ENGINE ---
+# Pool settings per backend, all from the environment. Neon suspends idle computes and
+# its pooler drops idle connections, so connections are pinged on checkout and recycled
+# before they go stale. Each gunicorn worker gets its own pool: keep
+# workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW) under the database's connection limit.
+def engine_options(uri):
+    if uri.startswith('sqlite'):
+        return {}  # one file, SQLAlchemy's default pool; the tuning is in SQLITE_PRAGMAS
+    return {
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', 5)),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 5)),
+        'pool_timeout': float(os.environ.get('DB_POOL_TIMEOUT', 10)),
+        'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 300)),
+        'pool_pre_ping': os.environ.get('DB_POOL_PRE_PING', '1') == '1',
+    }
+
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config['SQLALCHEMY_DATABASE_URI'])
+
+# SQLite, set on every new connection: WAL lets readers carry on while a worker writes,
+# synchronous=NORMAL only syncs at checkpoints (an app crash loses nothing, a power cut
+# can lose the last commits), and busy_timeout makes writers queue for the lock instead
+# of failing with "database is locked". An empty value leaves SQLite's default.
+SQLITE_PRAGMAS = {
+    'journal_mode': os.environ.get('SQLITE_JOURNAL_MODE', 'WAL'),
+    'synchronous': os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL'),
+    'busy_timeout': os.environ.get('SQLITE_BUSY_TIMEOUT_MS', '5000'),
+}
+
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    for name, value in SQLITE_PRAGMAS.items():
+        if value:
+            cursor.execute(f"PRAGMA {name} = {value}")
+    cursor.close()
+
+
+# --- READ REPLICA ---
+# Optional. With REPLICA_DB_URI set, GET requests to @read_replica views (catalog,
+# product pages, admin reports) run their SELECTs on the replica; writes and every
+# other view stay on the primary. A visitor who just wrote something (checkout, a
+# review, an edit...) reads from the primary for REPLICA_LAG_SECONDS, so they never
+# see the page from before their own change. Set it above the replica's worst lag.
+# Local testing: point REPLICA_DB_URI at a second SQLite file and copy the primary
+# over it with `flask sync-replica` whenever the "replica" should catch up.
+app.config['REPLICA_DB_URI'] = os.environ.get('REPLICA_DB_URI')
+REPLICA_LAG_SECONDS = float(os.environ.get('REPLICA_LAG_SECONDS', 5))
+if app.config['REPLICA_DB_URI']:
+    app.config['SQLALCHEMY_BINDS'] = {
+        'replica': {'url': app.config['REPLICA_DB_URI'], **engine_options(app.config['REPLICA_DB_URI'])},
+    }
+
+def read_replica(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if request.method == 'GET' and session.get('primary_until', 0) < time():
+            g.use_replica = True
+        return f(*args, **kwargs)
+    return decorated_function
+
+def use_primary():
+    """Read the rest of this request from the primary."""
+    g.use_replica = False
+
+@app.after_request
+def stick_to_primary(response):
+    if g.get('wrote_primary'):
+        session['primary_until'] = time() + REPLICA_LAG_SECONDS
+    return response
+
+@app.cli.command('sync-replica')
+def sync_replica():
+    """Local testing: copy the primary SQLite file over the replica one."""
+    primary, replica = db.engines[None], db.engines.get('replica')
+    if replica is None or primary.dialect.name != 'sqlite' or replica.dialect.name != 'sqlite':
+        print("❌ Needs SQLite files for both DB_URI and REPLICA_DB_URI.")
+        sys.exit(1)
+    source = sqlite3.connect(primary.url.database)
+    target = sqlite3.connect(replica.url.database)
+    source.backup(target)
+    source.close()
+    target.close()
+    print(f"✅ Replica {replica.url.database} synced.")
+
 
 mail = Mail(app)
+# Lets pages put the CSRF token in a <meta> tag for the fetch() based cart API
+app.jinja_env.globals['csrf_token'] = generate_csrf
 
 db.init_app(app)
 
@@ -170,45 +308,67 @@ def load_user(user_id):
     return db.session.get(User, int(user_id))
 
 
+# The composite key stops the same product being saved twice and covers "this user's
+# wishlist"; the product_id index covers the reverse (wished_by) lookup
 wishlist_table = db.Table('wishlist',
-    db.Column('user_id', db.Integer, db.ForeignKey('user.id')),
-    db.Column('product_id', db.Integer, db.ForeignKey('product.id'))
+    db.Column('user_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+    db.Column('product_id', db.Integer, db.ForeignKey('product.id'), primary_key=True, index=True)
 )
 
 #Database
-class Product(db.Model):
+class ResponsiveImage:
+    """Shared by Product and ProductImage.
+
+    image_key points at the variants the image pipeline wrote at upload time.
+    Rows from before the pipeline only have image_url and fall back to it.
+    """
+    image_key = db.Column(db.String(64))
+    # 'pending' while the upload worker builds the variants, 'failed' if it gave up
+    image_status = db.Column(db.String(20))
+    watermark = False
+
+    def image_src(self, size='card', ext='jpg'):
+        if self.image_status:
+            return self.image_url  # still the placeholder
+        if self.image_key:
+            return image_storage.url(variant_path(self.image_key, size, ext))
+        return legacy_image_url(self.image_url, IMAGE_SIZES[size], ext, self.watermark)
+
+    def image_srcset(self, ext='jpg'):
+        # Plain external URLs only come in one size, so there is nothing to offer
+        if self.image_status or (not self.image_key and not is_cloudinary_url(self.image_url)):
+            return ''
+        return ', '.join(f"{self.image_src(size, ext)} {width}w" for size, width in IMAGE_SIZES.items())
+
+class Product(ResponsiveImage, db.Model):
     id: Mapped[int] = mapped_column(Integer,primary_key=True)
     title: Mapped[str] = mapped_column(String(250))
     price: Mapped[int] = mapped_column(Integer)
     description: Mapped[str] = mapped_column(String(500))
     image_url: Mapped[str] = mapped_column(String(250))
+    # Stable id for bulk import/export (products made through the admin form start without one)
+    sku: Mapped[str] = mapped_column(String(64), unique=True, index=True, nullable=True)
+    # Units left; None means unlimited. Only ever changed with conditional UPDATEs
+    # (checkout and cancel add/subtract, edit_product compares-and-sets)
+    stock: Mapped[int] = mapped_column(Integer, nullable=True)
+    watermark = True  # main photos carry the FAKE SHOP overlay, gallery shots don't
+    # Denormalized review aggregates so the catalog never has to load the review table
+    rating_sum: Mapped[int] = mapped_column(Integer, default=0, server_default='0')
+    rating_count: Mapped[int] = mapped_column(Integer, default=0, server_default='0')
+    # Bumped on every change to the product, its reviews or its images (feeds the ETag)
+    updated_at: Mapped[datetime] = mapped_column(db.DateTime, default=datetime.now, onupdate=datetime.now, nullable=True)
     reviews = db.relationship('Review', backref='product', cascade="all, delete")
 
     images = db.relationship('ProductImage', backref='product', lazy=True)
     def get_rating(self):
-        if not self.reviews:
+        if not self.rating_count:
             return 0
-        total_stars = sum([review.rating for review in self.reviews])
-        return round(total_stars / len(self.reviews), 1)
-    
-    def get_watermarked_image(self):
-        if not self.image_url or "cloudinary" not in self.image_url:
-            return self.image_url
-        
-        try:
-            if "/upload/" not in self.image_url:
-                return self.image_url
-                
-            parts = self.image_url.split("/upload/", 1)
-            transformation = "w_800/l_text:Arial_50_bold:FAKE%20SHOP,co_rgb:FFFFFF,o_40,g_south_east,x_20,y_20/"
-            return f"{parts[0]}/upload/{transformation}{parts[1]}"
-        except:
-            return self.image_url  # Fallback to original
-
-class ProductImage(db.Model):
+        return round(self.rating_sum / self.rating_count, 1)
+
+class ProductImage(ResponsiveImage, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     image_url = db.Column(db.String(250), nullable=False)
-    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False, index=True)
 
 
 class User(UserMixin,db.Model):
@@ -227,9 +387,9 @@ class User(UserMixin,db.Model):
 
 class SearchTerm(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    term = db.Column(db.String(100)) # e.g., "iphone"
+    term = db.Column(db.String(100), unique=True, index=True) # e.g., "iphone"
     count = db.Column(db.Integer, default=1) # How many times searched?
-    last_searched = db.Column(db.String(20)) # Timestamp
+    last_searched = db.Column(db.DateTime, index=True) # Timestamp
 
 class Coupon(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -240,22 +400,58 @@ class Coupon(db.Model):
 class Order(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     # Foreign Key: Links to the User table
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
-    date = db.Column(db.String(20)) # Storing simple string for now (e.g., "2025-01-05")
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
+    date = db.Column(db.DateTime, default=datetime.now, index=True) # When the order was placed
     total_price = db.Column(db.Integer) # Stored in Cents
-    # Default status is 'Pending' when created
-    status = db.Column(db.String(50), default="Pending")
+    # Default status is 'Pending' when created (indexed: admin filter + navbar pending count)
+    status = db.Column(db.String(50), default="Pending", index=True)
     # Relationship: One Order has Many Items
     items = db.relationship('OrderItem', backref='order')
 
     discount_amount = db.Column(db.Integer, default=0)
 
+    # Loader option sets, defined once so every order page loads the same way
+    @classmethod
+    def list_loads(cls):
+        """For order tables that show the customer but not the items."""
+        return cls._strict([joinedload(cls.customer)])
+
+    @classmethod
+    def detail_loads(cls):
+        """For anything that walks order.items and item.product (receipts, CSV, history)."""
+        return cls._strict([joinedload(cls.customer), selectinload(cls.items).joinedload(OrderItem.product)])
+
+    @staticmethod
+    def _strict(options):
+        # In strict mode any relationship NOT listed above raises instead of lazy-loading
+        if app.config['STRICT_QUERIES']:
+            options.append(raiseload('*'))
+        return options
+
+    # PDF invoice: None (never requested), pending, ready or failed
+    invoice_status = db.Column(db.String(20))
+
+
+class CartItem(db.Model):
+    # Server-side cart line (the session cookie only carries the login id now)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), primary_key=True)
+    quantity = db.Column(db.Integer, default=1)
+
+
+class DailySales(db.Model):
+    # Rollup of non-cancelled orders per day, kept current by checkout/cancel_order
+    __tablename__ = 'daily_sales'
+    day = db.Column(db.Date, primary_key=True)
+    revenue = db.Column(db.Integer, default=0) # Stored in Cents
+    orders = db.Column(db.Integer, default=0)
+
 
 class OrderItem(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    # Foreign Keys: Links to Order AND Product
-    order_id = db.Column(db.Integer, db.ForeignKey('order.id'))
-    product_id = db.Column(db.Integer, db.ForeignKey('product.id'))
+    # Foreign Keys: Links to Order AND Product (indexed: order.items loads, product deletes)
+    order_id = db.Column(db.Integer, db.ForeignKey('order.id'), index=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), index=True)
     
     quantity = db.Column(db.Integer)
     price_at_purchase = db.Column(db.Integer) # CRITICAL: Snapshot the price!
@@ -269,26 +465,950 @@ class Review(db.Model):
     text = db.Column(db.String(1000))
     
     # Foreign Keys
-    product_id = db.Column(db.Integer, db.ForeignKey('product.id'))
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
     
     # Optional: Timestamp (Good for sorting)
-    date_posted = db.Column(db.String(20)) # e.g. "2025-01-06"
+    date_posted = db.Column(db.DateTime, default=datetime.now, index=True)
 
+class OutboxEmail(db.Model):
+    # Every outgoing email is written here first, so a dead worker can't lose mail
+    id = db.Column(db.Integer, primary_key=True)
+    subject = db.Column(db.String(250))
+    sender = db.Column(db.String(100))
+    recipients = db.Column(db.Text) # JSON list
+    body = db.Column(db.Text)
+    attachment_name = db.Column(db.String(100))
+    attachment_type = db.Column(db.String(100))
+    attachment_data = db.Column(db.LargeBinary)
+
+    # pending -> sending -> sent, or failed after MAIL_MAX_ATTEMPTS
+    status = db.Column(db.String(20), default="pending", index=True)
+    attempts = db.Column(db.Integer, default=0)
+    # When a pending row may be tried again / when a 'sending' claim expires
+    next_attempt_at = db.Column(db.DateTime, default=datetime.now, index=True)
+    last_error = db.Column(db.String(500))
+    created_at = db.Column(db.DateTime, default=datetime.now)
+
+
+# Keep Product.rating_sum / rating_count in step with the review table.
+# These run inside the same flush, so the aggregate commits (or rolls back) with the review.
+@event.listens_for(Review, 'after_insert')
+def review_added(mapper, connection, review):
+    connection.execute(
+        db.update(Product)
+        .where(Product.id == review.product_id)
+        .values(rating_sum=Product.rating_sum + review.rating,
+                rating_count=Product.rating_count + 1,
+                updated_at=datetime.now())
+    )
+    invalidate_catalog(connection)
+
+@event.listens_for(Review, 'after_delete')
+def review_removed(mapper, connection, review):
+    connection.execute(
+        db.update(Product)
+        .where(Product.id == review.product_id)
+        .values(rating_sum=Product.rating_sum - review.rating,
+                rating_count=Product.rating_count - 1,
+                updated_at=datetime.now())
+    )
+    invalidate_catalog(connection)
+
+# The gallery is part of the product page, so new or removed images touch the product too
+@event.listens_for(ProductImage, 'after_insert')
+@event.listens_for(ProductImage, 'after_update')
+@event.listens_for(ProductImage, 'after_delete')
+def product_image_changed(mapper, connection, image):
+    connection.execute(
+        db.update(Product).where(Product.id == image.product_id).values(updated_at=datetime.now())
+    )
+
+
+# --- FULL-TEXT SEARCH ---
+# SQLite gets an FTS5 table kept in sync by triggers, Postgres gets a generated
+# tsvector column with a GIN index. Anything else falls back to LIKE.
+# Neither stems: every search token is a prefix query, and "runn" is a prefix of
+# "running" but not of its stem "run".
+FTS_TABLE = 'product_fts'
+FTS_TRIGGERS = (f'{FTS_TABLE}_ai', f'{FTS_TABLE}_ad', f'{FTS_TABLE}_au')
+TS_CONFIG = 'simple'
+product_fts = table(FTS_TABLE, column('rowid'), column('rank'))
+search_backend = None  # looked up on first use, see current_search_backend()
+
+def current_search_backend():
+    """Which index the migrations built. A catalog lookup only, the DDL lives in setup_search_index()."""
+    global search_backend
+    if search_backend is None:
+        dialect = db.engine.dialect.name
+        if dialect == 'sqlite':
+            found = db.session.execute(
+                text("SELECT 1 FROM sqlite_master WHERE name = :name"), {'name': FTS_TABLE}
+            ).scalar()
+            search_backend = 'fts5' if found else 'like'
+        elif dialect == 'postgresql':
+            found = db.session.execute(text(
+                "SELECT 1 FROM information_schema.columns WHERE table_name = 'product' AND column_name = 'search_vector'"
+            )).scalar()
+            search_backend = 'tsvector' if found else 'like'
+        else:
+            search_backend = 'like'
+    return search_backend
 
+def setup_search_index():
+    global search_backend
+    dialect = db.engine.dialect.name
 
-with app.app_context():
+    if dialect == 'sqlite':
+        exists = db.session.execute(
+            text("SELECT name FROM sqlite_master WHERE name = :name"), {'name': FTS_TABLE}
+        ).scalar()
+        try:
+            db.session.execute(text(f"""
+                CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(
+                    title, description, content='product', content_rowid='id',
+                    tokenize='unicode61', prefix='2 3')"""))
+        except Exception as e:
+            # Python was built against an SQLite without FTS5
+            db.session.rollback()
+            print(f"FTS5 unavailable, search falls back to LIKE: {e}")
+            return
+        # External-content tables need triggers to follow the product table
+        db.session.execute(text(f"""
+            CREATE TRIGGER IF NOT EXISTS product_fts_ai AFTER INSERT ON product BEGIN
+                INSERT INTO {FTS_TABLE}(rowid, title, description) VALUES (new.id, new.title, new.description);
+            END"""))
+        db.session.execute(text(f"""
+            CREATE TRIGGER IF NOT EXISTS product_fts_ad AFTER DELETE ON product BEGIN
+                INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, title, description) VALUES ('delete', old.id, old.title, old.description);
+            END"""))
+        db.session.execute(text(f"""
+            CREATE TRIGGER IF NOT EXISTS product_fts_au AFTER UPDATE OF title, description ON product BEGIN
+                INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, title, description) VALUES ('delete', old.id, old.title, old.description);
+                INSERT INTO {FTS_TABLE}(rowid, title, description) VALUES (new.id, new.title, new.description);
+            END"""))
+        if not exists:
+            # First boot on an existing catalog: index what is already there,
+            # and weight title hits 10x over description hits in the rank column
+            db.session.execute(text(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')"))
+            db.session.execute(text(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rank) VALUES ('rank', 'bm25(10.0, 1.0)')"))
+        db.session.commit()
+        search_backend = 'fts5'
+
+    elif dialect == 'postgresql':
+        # A generated column backfills itself and follows every UPDATE, no triggers needed
+        db.session.execute(text(f"""
+            ALTER TABLE product ADD COLUMN IF NOT EXISTS search_vector tsvector
+            GENERATED ALWAYS AS (
+                setweight(to_tsvector('{TS_CONFIG}', coalesce(title, '')), 'A') ||
+                setweight(to_tsvector('{TS_CONFIG}', coalesce(description, '')), 'B')
+            ) STORED"""))
+        db.session.execute(text("CREATE INDEX IF NOT EXISTS ix_product_search_vector ON product USING GIN (search_vector)"))
+        db.session.commit()
+        search_backend = 'tsvector'
+
+def search_products(stmt, search_query):
+    """Filter a Product select by search_query. Returns (stmt, rank) where a lower rank sorts first."""
+    # Only keep word characters, so user input can never break the MATCH / tsquery syntax
+    tokens = re.findall(r'\w+', search_query.lower())
+    if not tokens:
+        return stmt.where(db.false()), None
+
+    backend = current_search_backend()
+    if backend == 'fts5':
+        # Prefix match on every token, all tokens required ("run sho" finds "Running Shoes")
+        match = ' '.join(f'"{token}"*' for token in tokens)
+        stmt = stmt.join(product_fts, product_fts.c.rowid == Product.id).where(
+            text(f"{FTS_TABLE} MATCH :match").bindparams(match=match)
+        )
+        return stmt, product_fts.c.rank
+
+    if backend == 'tsvector':
+        tsquery = func.to_tsquery(TS_CONFIG, ' & '.join(f'{token}:*' for token in tokens))
+        vector = literal_column('product.search_vector')
+        stmt = stmt.where(vector.op('@@')(tsquery))
+        return stmt, -func.ts_rank_cd(vector, tsquery)
+
+    like = f'%{search_query}%'
+    return stmt.where(Product.title.like(like) | Product.description.like(like)), None
+
+
+def upsert_insert(model, rows, keys, add, replace=()):
+    """INSERT rows into model; a row that clashes on keys instead adds its `add` columns to
+    the existing row and overwrites its `replace` columns. One ON CONFLICT statement on
+    SQLite/Postgres, get-or-create per row anywhere else. The caller commits."""
+    dialect = db.engine.dialect.name
+    if dialect in ('sqlite', 'postgresql'):
+        insert = sqlite.insert if dialect == 'sqlite' else postgresql.insert
+        stmt = insert(model).values(rows)
+        set_ = {name: getattr(model, name) + stmt.excluded[name] for name in add}
+        set_.update({name: stmt.excluded[name] for name in replace})
+        db.session.execute(stmt.on_conflict_do_update(index_elements=[getattr(model, key) for key in keys], set_=set_))
+        return
+    for row in rows:
+        existing = db.session.execute(db.select(model).filter_by(**{key: row[key] for key in keys})).scalar()
+        if existing is None:
+            db.session.add(model(**row))
+            continue
+        for name in add:
+            setattr(existing, name, (getattr(existing, name) or 0) + row[name])
+        for name in replace:
+            setattr(existing, name, row[name])
+
+
+class PerProcess:
+    """Base for the background pools. Threads, queues and process pools don't survive a
+    fork, so each gunicorn worker builds its own: ensure_started() calls _start() on first
+    use in every process."""
+    pid = None
+
+    def ensure_started(self):
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self._start()
+
+    def _start(self):
+        raise NotImplementedError
+
+
+# --- SEARCH ANALYTICS BUFFER ---
+# Counting searches used to cost a SELECT + UPDATE + COMMIT per page view.
+# Terms are now counted in memory and written with one bulk upsert every few
+# seconds, when the buffer gets big, or when the worker shuts down.
+class SearchTermBuffer(PerProcess):
+    def __init__(self, flush_seconds, max_terms):
+        self.flush_seconds = flush_seconds
+        self.max_terms = max_terms
+        self.counts = Counter()
+        self.lock = Lock()
+        self.wake = Event()
+
+    def record(self, term):
+        with self.lock:
+            self.counts[term] += 1
+            full = len(self.counts) >= self.max_terms
+        self.ensure_started()
+        if full:
+            self.wake.set()
+
+    def _start(self):
+        Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        while True:
+            self.wake.wait(self.flush_seconds)
+            self.wake.clear()
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            pending, self.counts = self.counts, Counter()
+        if not pending:
+            return
+        try:
+            with app.app_context():
+                upsert_search_terms(pending)
+        except Exception as e:
+            # Put the counts back so the next flush retries them
+            print(f"Search term flush failed: {e}")
+            with self.lock:
+                self.counts.update(pending)
+
+def upsert_search_terms(pending):
+    now = datetime.now()
+    rows = [{'term': term, 'count': count, 'last_searched': now} for term, count in pending.items()]
+    upsert_insert(SearchTerm, rows, keys=['term'], add=['count'], replace=['last_searched'])
+    db.session.commit()
+
+search_buffer = SearchTermBuffer(
+    flush_seconds=float(os.environ.get('SEARCH_FLUSH_SECONDS', 10)),
+    max_terms=int(os.environ.get('SEARCH_FLUSH_SIZE', 500)),
+)
+# gunicorn workers exit through sys.exit, so atexit catches graceful shutdowns and restarts
+atexit.register(search_buffer.flush)
+
+
+def add_missing_columns(columns=None):
+    """create_all() never alters existing tables, so add the model columns the database lacks.
+
+    columns: 'table.column' names to limit it to (a migration adds its own columns only).
+    """
+    inspector = inspect(db.engine)
+    added = []
+    for mapped in db.metadata.sorted_tables:
+        if not inspector.has_table(mapped.name):
+            continue
+        existing = {col['name'] for col in inspector.get_columns(mapped.name)}
+        for col in mapped.columns:
+            if col.name in existing or (columns is not None and f"{mapped.name}.{col.name}" not in columns):
+                continue
+            ddl = f'ALTER TABLE "{mapped.name}" ADD COLUMN "{col.name}" {col.type.compile(dialect=db.engine.dialect)}'
+            if col.server_default is not None:
+                ddl += f" DEFAULT {col.server_default.arg}"
+            db.session.execute(text(ddl))
+            added.append(f"{mapped.name}.{col.name}")
+    db.session.commit()
+    return added
+
+
+def add_missing_indexes():
+    """Same idea for indexes declared on the models (index=True / db.Index)."""
+    inspector = inspect(db.engine)
+    added = []
+    for mapped in db.metadata.sorted_tables:
+        if not inspector.has_table(mapped.name):
+            continue
+        existing = {index['name'] for index in inspector.get_indexes(mapped.name)}
+        for index in mapped.indexes:
+            if index.name not in existing:
+                index.create(bind=db.engine)
+                added.append(index.name)
+    return added
+
+
+def add_wishlist_primary_key():
+    """Older databases have a wishlist table with no key, so the same pair could be saved twice."""
+    inspector = inspect(db.engine)
+    if not inspector.has_table('wishlist') or inspector.get_pk_constraint('wishlist')['constrained_columns']:
+        return []
+    if db.engine.dialect.name == 'sqlite':
+        # SQLite can't add a primary key to an existing table: rebuild it without the duplicates
+        db.session.execute(text('ALTER TABLE wishlist RENAME TO wishlist_old'))
+        db.session.commit()
+        wishlist_table.create(bind=db.engine)
+        db.session.execute(text(
+            'INSERT INTO wishlist (user_id, product_id) SELECT DISTINCT user_id, product_id FROM wishlist_old '
+            'WHERE user_id IS NOT NULL AND product_id IS NOT NULL'
+        ))
+        db.session.execute(text('DROP TABLE wishlist_old'))
+    else:
+        db.session.execute(text('DELETE FROM wishlist WHERE user_id IS NULL OR product_id IS NULL'))
+        db.session.execute(text(
+            'DELETE FROM wishlist a USING wishlist b '
+            'WHERE a.ctid < b.ctid AND a.user_id = b.user_id AND a.product_id = b.product_id'
+        ))
+        db.session.execute(text('ALTER TABLE wishlist ADD PRIMARY KEY (user_id, product_id)'))
+    db.session.commit()
+    return ['wishlist primary key']
+
+
+def hot_queries():
+    # (label, statement) for the lookups the pages and relationship loads run all the time
+    return [
+        ("items of an order", db.select(OrderItem).where(OrderItem.order_id == 1)),
+        ("order lines of a product", db.select(OrderItem.id).where(OrderItem.product_id == 1)),
+        ("orders of a user", db.select(Order).where(Order.user_id == 1)),
+        ("pending orders count", db.select(func.count(Order.id)).where(Order.status == 'Pending')),
+        ("reviews of a product", db.select(Review).where(Review.product_id == 1)),
+        ("reviews by a user", db.select(Review).where(Review.user_id == 1)),
+        ("images of a product", db.select(ProductImage).where(ProductImage.product_id == 1)),
+        ("wishlist of a user", db.select(wishlist_table).where(wishlist_table.c.user_id == 1)),
+        ("users wishing a product", db.select(wishlist_table).where(wishlist_table.c.product_id == 1)),
+        ("search term lookup", db.select(SearchTerm).where(SearchTerm.term == 'shoe')),
+        ("cart of a user", db.select(CartItem).where(CartItem.user_id == 1)),
+        ("product by sku", db.select(Product).where(Product.sku == 'FS-1')),
+    ]
+
+def query_plan(stmt):
+    sql = str(stmt.compile(dialect=db.engine.dialect, compile_kwargs={'literal_binds': True}))
+    if db.engine.dialect.name == 'sqlite':
+        return [row[-1] for row in db.session.execute(text(f"EXPLAIN QUERY PLAN {sql}"))]
+    # Tiny dev tables make Postgres prefer a seq scan anyway; we want to know if it COULD use an index
+    db.session.execute(text("SET LOCAL enable_seqscan = off"))
+    return db.session.execute(text(f"EXPLAIN {sql}")).scalars().all()
+
+def plan_uses_index(plan):
+    if db.engine.dialect.name == 'sqlite':
+        # "SCAN order_item" is a full scan; "SEARCH order_item USING INDEX ..." is what we want
+        return not any(line.startswith('SCAN') and 'USING' not in line for line in plan)
+    return not any('Seq Scan' in line for line in plan)
+
+@app.cli.command('check-query-plans')
+def check_query_plans():
+    """Fail (exit 1) if any of the hot lookups would scan a whole table."""
+    failures = 0
+    for label, stmt in hot_queries():
+        plan = query_plan(stmt)
+        if plan_uses_index(plan):
+            print(f"✅ {label}: {plan[0].strip()}")
+        else:
+            failures += 1
+            print(f"❌ {label}:")
+            for line in plan:
+                print(f"      {line}")
+    db.session.rollback()
+    if failures:
+        print(f"❌ {failures} queries scan a table. Run 'flask upgrade-db'?")
+        sys.exit(1)
+
+
+def backfill_in_batches(target, values, batch_size):
+    """UPDATE target SET values, one id range (and one short transaction) at a time.
+
+    A single UPDATE over a big table holds its row locks until it commits; in batches
+    the site keeps serving, and a killed run can simply be started again.
+    """
+    max_id = db.session.execute(db.select(func.max(target.c.id))).scalar() or 0
+    for low in range(0, max_id, batch_size):
+        db.session.execute(
+            db.update(target).where(target.c.id > low, target.c.id <= low + batch_size).values(**values)
+        )
+        db.session.commit()
+    return max_id
+
+
+# Migrations must not go through the models: a step written today has to run against
+# a database that doesn't have tomorrow's columns yet (e.g. product.updated_at)
+product_ratings = table('product', column('id'), column('rating_sum'), column('rating_count'), column('updated_at'))
+
+def backfill_rating_aggregates(batch_size=1000, touch=False):
+    # Set-based UPDATE with correlated subqueries (no rows pulled into Python)
+    review = table('review', column('product_id'), column('rating'))
+    values = {
+        'rating_sum': db.select(func.coalesce(func.sum(review.c.rating), 0))
+            .where(review.c.product_id == product_ratings.c.id).scalar_subquery(),
+        'rating_count': db.select(func.count())
+            .where(review.c.product_id == product_ratings.c.id).scalar_subquery(),
+    }
+    if touch:
+        values['updated_at'] = datetime.now()  # new ETags for the product pages
+    return backfill_in_batches(product_ratings, values, batch_size)
+
+
+@app.cli.command('backfill-ratings')
+@click.option('--batch-size', default=1000, help='Products updated per transaction.')
+def backfill_ratings(batch_size):
+    """Recompute the rating aggregates from the review table (repair)."""
+    scanned = backfill_rating_aggregates(batch_size, touch=True)
+    bump_catalog_version()
+    print(f"✅ Rating aggregates rebuilt ({scanned} products scanned).")
+
+
+def rebuild_daily_sales_rollup():
+    day = func.date(Order.date)
+    totals = db.session.execute(
+        db.select(day, func.sum(Order.total_price), func.count(Order.id))
+        .where(Order.status != 'Cancelled', Order.date.is_not(None))
+        .group_by(day)
+    ).all()
+
+    db.session.execute(db.delete(DailySales))
+    if totals:
+        # date() comes back as a string on SQLite and as a date on Postgres
+        db.session.execute(db.insert(DailySales), [
+            {'day': datetime.strptime(day, '%Y-%m-%d').date() if isinstance(day, str) else day,
+             'revenue': revenue or 0, 'orders': count}
+            for day, revenue, count in totals
+        ])
+    db.session.commit()
+    return len(totals)
+
+
+@app.cli.command('rebuild-daily-sales')
+def rebuild_daily_sales():
+    """Recompute the daily_sales rollup from the order table (repair)."""
+    days = rebuild_daily_sales_rollup()
+    print(f"✅ Rebuilt daily sales for {days} days.")
+
+
+# Columns that used to hold strftime('%Y-%m-%d') strings
+DATETIME_COLUMNS = [('order', 'date'), ('review', 'date_posted'), ('search_term', 'last_searched')]
+
+def convert_datetime_columns(batch_size=1000):
+    """Convert the old date strings to real datetimes in small batches."""
+    dialect = db.engine.dialect.name
+    for table_name, column_name in DATETIME_COLUMNS:
+        max_id = db.session.execute(text(f'SELECT MAX(id) FROM "{table_name}"')).scalar() or 0
+
+        if dialect == 'postgresql':
+            column = next(col for col in inspect(db.engine).get_columns(table_name) if col['name'] == column_name)
+            if isinstance(column['type'], db.DateTime):
+                print(f"   {table_name}.{column_name} is already a timestamp, skipping.")
+                continue
+            # Expand: fill a new timestamp column batch by batch while the app keeps running
+            temp_name = f"{column_name}__ts"
+            db.session.execute(text(f'ALTER TABLE "{table_name}" ADD COLUMN IF NOT EXISTS "{temp_name}" TIMESTAMP'))
+            db.session.commit()
+            for low in range(0, max_id, batch_size):
+                db.session.execute(text(
+                    f'UPDATE "{table_name}" SET "{temp_name}" = NULLIF("{column_name}", \'\')::timestamp '
+                    f'WHERE id > :low AND id <= :high'
+                ), {'low': low, 'high': low + batch_size})
+                db.session.commit()
+            # Contract: catch up rows written meanwhile and swap, in one short locked transaction
+            db.session.execute(text(f'LOCK TABLE "{table_name}" IN SHARE ROW EXCLUSIVE MODE'))
+            db.session.execute(text(
+                f'UPDATE "{table_name}" SET "{temp_name}" = NULLIF("{column_name}", \'\')::timestamp '
+                f'WHERE "{temp_name}" IS NULL AND "{column_name}" IS NOT NULL'
+            ))
+            db.session.execute(text(f'ALTER TABLE "{table_name}" DROP COLUMN "{column_name}"'))
+            db.session.execute(text(f'ALTER TABLE "{table_name}" RENAME COLUMN "{temp_name}" TO "{column_name}"'))
+            db.session.commit()
+        else:
+            # SQLite stores datetimes as ISO text, so the column only needs its values
+            # padded to the full format (otherwise '2025-01-05' < '2025-01-05 00:00:00')
+            for low in range(0, max_id, batch_size):
+                db.session.execute(text(
+                    f'UPDATE "{table_name}" SET "{column_name}" = CASE WHEN "{column_name}" = \'\' THEN NULL '
+                    f'ELSE "{column_name}" || \' 00:00:00.000000\' END '
+                    f'WHERE id > :low AND id <= :high AND ("{column_name}" = \'\' OR length("{column_name}") = 10)'
+                ), {'low': low, 'high': low + batch_size})
+                db.session.commit()
+        print(f"   {table_name}.{column_name} converted ({max_id} rows scanned).")
+
+
+@app.cli.command('rebuild-search-index')
+def rebuild_search_index():
+    """Re-index every product (Postgres keeps its generated column in sync on its own)."""
+    backend = current_search_backend()
+    if backend == 'fts5':
+        resume_search_triggers()  # also recreates any missing trigger
+    print(f"✅ Search index rebuilt (backend: {backend}).")
+
+
+def merge_duplicate_search_terms():
+    """Merge duplicate search_term rows into the oldest one, then add the unique index the upsert relies on."""
+    # Set-based statements on a table() construct (no rows pulled into Python, no model)
+    search_term = table('search_term', column('id'), column('term'), column('count'), column('last_searched'))
+    same_term = search_term.alias('same_term')
+    keepers = (db.select(func.min(search_term.c.id)).group_by(search_term.c.term)
+               .having(func.count(search_term.c.id) > 1))
+    duplicates = db.session.execute(db.select(func.count()).select_from(keepers.subquery())).scalar()
+
+    if duplicates:
+        db.session.execute(
+            search_term.update().where(search_term.c.id.in_(keepers)).values(
+                count=db.select(func.coalesce(func.sum(same_term.c.count), 0))
+                    .where(same_term.c.term == search_term.c.term).scalar_subquery(),
+                last_searched=db.select(func.max(same_term.c.last_searched))
+                    .where(same_term.c.term == search_term.c.term).scalar_subquery(),
+            )
+        )
+        db.session.execute(search_term.delete().where(
+            search_term.c.id.not_in(db.select(func.min(search_term.c.id)).group_by(search_term.c.term))
+        ))
+
+    db.session.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS ix_search_term_term ON search_term (term)"))
+    db.session.commit()
+    print(f"   Merged {duplicates} duplicated search terms.")
+
+
+# --- SCHEMA MIGRATIONS ---
+# Versioned, forward-only steps, applied in order by `flask upgrade-db` and recorded in
+# schema_migrations. Deploys run it once as a release step (see procfile) BEFORE the new
+# code starts serving; the web workers themselves never issue DDL.
+# Every step is idempotent (it checks before it alters), so a fresh database just gets
+# create_all() plus a string of no-ops, and a step that died halfway can be rerun.
+# Data backfills go in batches of --batch-size rows, one short transaction each, so
+# they are safe to run against a live site.
+# New schema change? Add a step at the bottom; never edit one that has shipped.
+schema_migrations = db.Table('schema_migrations',
+    db.Column('version', db.String(100), primary_key=True),
+    db.Column('applied_at', db.DateTime, default=datetime.now),
+)
+MIGRATIONS = []
+MIGRATION_LOCK_ID = 7252201  # pg_advisory_lock key, so two releases can't migrate at once
+
+def migration(version):
+    def register(fn):
+        MIGRATIONS.append((version, fn))
+        return fn
+    return register
+
+@migration('0001_initial_schema')
+def create_tables(batch_size):
+    # Only creates the tables that don't exist yet (all of them on a fresh database)
     db.create_all()
 
+@migration('0002_soft_delete_and_coupons')
+def add_soft_delete_and_coupons(batch_size):
+    # Used to be the /add_deleted_flag and /init_coupons routes (the coupon table itself comes from 0001)
+    add_missing_columns(['user.is_deleted', 'order.discount_amount'])
+
+@migration('0003_rating_aggregates')
+def add_rating_aggregates(batch_size):
+    add_missing_columns(['product.rating_sum', 'product.rating_count'])
+    backfill_rating_aggregates(batch_size)
+
+@migration('0004_full_text_search')
+def add_full_text_search(batch_size):
+    setup_search_index()
+
+@migration('0005_real_datetimes')
+def add_real_datetimes(batch_size):
+    convert_datetime_columns(batch_size)
+
+@migration('0006_unique_search_terms')
+def add_unique_search_terms(batch_size):
+    merge_duplicate_search_terms()
+
+@migration('0007_invoice_status')
+def add_invoice_status(batch_size):
+    add_missing_columns(['order.invoice_status'])
+
+@migration('0008_image_pipeline')
+def add_image_pipeline_columns(batch_size):
+    add_missing_columns(['product.updated_at', 'product.image_key', 'product.image_status',
+                         'product_image.image_key', 'product_image.image_status'])
+
+@migration('0009_product_sku')
+def add_product_sku(batch_size):
+    add_missing_columns(['product.sku'])
+
+@migration('0010_wishlist_primary_key')
+def add_wishlist_key(batch_size):
+    add_wishlist_primary_key()
+
+@migration('0011_model_indexes')
+def add_model_indexes(batch_size):
+    # Foreign keys, the date/status filters, product.sku (unique)
+    add_missing_indexes()
+
+@migration('0012_daily_sales_rollup')
+def backfill_daily_sales(batch_size):
+    rebuild_daily_sales_rollup()
+
+@migration('0013_product_stock')
+def add_product_stock(batch_size):
+    # NULL for existing products, i.e. unlimited until the admin sets a number
+    add_missing_columns(['product.stock'])
+
+@migration('0014_catalog_version')
+def add_catalog_version(batch_size):
+    catalog_version_table.create(bind=db.engine, checkfirst=True)
+    if db.session.execute(db.select(catalog_version_table.c.id)).first() is None:
+        db.session.execute(catalog_version_table.insert().values(id=1, version=time_ns()))
+        db.session.commit()
 
-def send_async_email(app, msg):
-    # We must pass the app context so Flask-Mail knows our config in the background
-    with app.app_context():
+@migration('0015_product_skus')
+def add_missing_skus(batch_size):
+    # Export used to assign these as a side effect
+    assign_missing_skus()
+    db.session.commit()
+
+
+def applied_migrations():
+    schema_migrations.create(bind=db.engine, checkfirst=True)
+    return set(db.session.execute(db.select(schema_migrations.c.version)).scalars())
+
+def pending_migrations():
+    applied = applied_migrations()
+    return [(version, step) for version, step in MIGRATIONS if version not in applied]
+
+def migrate_database(batch_size=1000):
+    """Apply every pending step in order. Returns the versions applied."""
+    lock = None
+    if db.engine.dialect.name == 'postgresql':
+        # Held on its own connection for the whole run; the steps commit as they go
+        lock = db.engine.connect()
+        lock.exec_driver_sql(f"SELECT pg_advisory_lock({MIGRATION_LOCK_ID})")
+    try:
+        done = []
+        for version, step in pending_migrations():
+            start = perf_counter()
+            print(f"⏳ {version}...")
+            step(batch_size)
+            db.session.execute(db.insert(schema_migrations).values(version=version, applied_at=datetime.now()))
+            db.session.commit()
+            print(f"✅ {version} ({perf_counter() - start:.1f}s)")
+            done.append(version)
+        return done
+    finally:
+        if lock is not None:
+            lock.exec_driver_sql(f"SELECT pg_advisory_unlock({MIGRATION_LOCK_ID})")
+            lock.close()
+
+
+@app.cli.command('upgrade-db')
+@click.option('--batch-size', default=1000, help='Rows per transaction in the data backfills.')
+@click.option('--dry-run', is_flag=True, help='Only list the pending migrations.')
+def upgrade_db(batch_size, dry_run):
+    """Apply the pending schema migrations (deploy step, before the new code serves traffic)."""
+    if dry_run:
+        pending = pending_migrations()
+        for version, _ in pending:
+            print(f"   {version}")
+        print(f"{len(pending)} pending of {len(MIGRATIONS)} migrations.")
+        return
+    done = migrate_database(batch_size)
+    print(f"✅ Applied {len(done)} migrations." if done else "✅ Schema already up to date.")
+    if repair_search_triggers():
+        print("🔎 The search triggers were missing (an interrupted catalog import?): recreated them and re-indexed.")
+
+
+@app.cli.command('outbox-worker')
+@click.option('--once', is_flag=True, help='Drain whatever is due and exit.')
+@click.option('--poll', default=5.0, help='Seconds to sleep when the outbox is empty.')
+def outbox_worker(once, poll):
+    """Send queued emails from a dedicated process instead of the web workers."""
+    print("📬 Outbox worker started.")
+    while True:
+        drain_outbox()
+        if once:
+            break
+        sleep(poll)
+
+
+# --- EMAIL OUTBOX ---
+# send_*_email helpers only INSERT into the outbox. A small, fixed pool of sender
+# threads (or the separate 'flask outbox-worker' process) claims due rows in
+# batches, pushes a whole batch through ONE SMTP connection and retries failures
+# with exponential backoff.
+OUTBOX_BATCH_SIZE = 20
+OUTBOX_CLAIM_SECONDS = 300  # a 'sending' row whose worker died is retried after this
+OUTBOX_BACKOFF_SECONDS = 30
+
+def after_commit(callback):
+    """Run callback once the current transaction commits (dropped if it rolls back)."""
+    db.session.info.setdefault('after_commit', []).append(callback)
+
+@event.listens_for(Session, 'after_commit')
+def run_after_commit_callbacks(session):
+    for callback in session.info.pop('after_commit', []):
         try:
-            mail.send(msg)
-            print("Email dispatched successfully.")
+            callback()
         except Exception as e:
-            print(f"Background email failed: {e}")
+            # The data is already committed: a failed side effect (cache, pool, Redis...)
+            # must not turn the request into a 500 or skip the callbacks after it
+            print(f"❌ ERROR: after-commit callback {callback!r} failed: {e}")
+
+@event.listens_for(Session, 'after_soft_rollback')
+def drop_after_commit_callbacks(session, previous_transaction):
+    if not session.in_transaction():
+        session.info.pop('after_commit', None)
+
+def queue_email(msg):
+    """Add msg to the outbox as part of the caller's transaction; the caller commits."""
+    attachment = msg.attachments[0] if msg.attachments else None
+    db.session.add(OutboxEmail(
+        subject=msg.subject,
+        sender=msg.sender,
+        recipients=json.dumps(list(msg.recipients)),
+        body=msg.body,
+        attachment_name=attachment.filename if attachment else None,
+        attachment_type=attachment.content_type if attachment else None,
+        attachment_data=attachment.data if attachment else None,
+    ))
+    after_commit(email_pool.wake_up)
+
+def build_message(row):
+    msg = Message(row.subject, sender=row.sender, recipients=json.loads(row.recipients), body=row.body)
+    if row.attachment_data:
+        msg.attach(row.attachment_name, row.attachment_type, row.attachment_data)
+    return msg
+
+def claim_outbox_batch():
+    """Atomically claim up to OUTBOX_BATCH_SIZE due emails for this worker."""
+    now = datetime.now()
+    due = db.session.execute(
+        db.select(OutboxEmail.id)
+        .where(OutboxEmail.status.in_(['pending', 'sending']), OutboxEmail.next_attempt_at <= now)
+        .order_by(OutboxEmail.id)
+        .limit(OUTBOX_BATCH_SIZE)
+    ).scalars().all()
+
+    claimed = []
+    for email_id in due:
+        # Conditional UPDATE: only one worker can win each row
+        result = db.session.execute(
+            db.update(OutboxEmail)
+            .where(OutboxEmail.id == email_id,
+                   OutboxEmail.status.in_(['pending', 'sending']),
+                   OutboxEmail.next_attempt_at <= now)
+            .values(status='sending', next_attempt_at=now + timedelta(seconds=OUTBOX_CLAIM_SECONDS))
+        )
+        if result.rowcount == 1:
+            claimed.append(email_id)
+    db.session.commit()
+
+    if not claimed:
+        return []
+    return db.session.execute(db.select(OutboxEmail).where(OutboxEmail.id.in_(claimed))).scalars().all()
+
+def send_outbox_batch():
+    """Send one claimed batch over a single SMTP connection. Returns how many rows were handled."""
+    batch = claim_outbox_batch()
+    if not batch:
+        return 0
+
+    try:
+        with mail.connect() as connection:
+            for row in batch:
+                try:
+                    connection.send(build_message(row))
+                    row.status = 'sent'
+                    row.attempts += 1
+                    row.last_error = None
+                except Exception as e:
+                    mark_email_failed(row, e)
+                db.session.commit()
+    except Exception as e:
+        # Could not reach the SMTP server (or it dropped us): whatever is left backs off
+        db.session.rollback()
+        for row in batch:
+            if row.status == 'sending':
+                mark_email_failed(row, e)
+        db.session.commit()
+    return len(batch)
+
+def mark_email_failed(row, error):
+    row.attempts += 1
+    row.last_error = str(error)[:500]
+    if row.attempts >= app.config['MAIL_MAX_ATTEMPTS']:
+        row.status = 'failed'
+        print(f"❌ Email #{row.id} failed permanently: {error}")
+    else:
+        row.status = 'pending'
+        row.next_attempt_at = datetime.now() + timedelta(seconds=OUTBOX_BACKOFF_SECONDS * 2 ** (row.attempts - 1))
+
+def drain_outbox():
+    with app.app_context():
+        while send_outbox_batch():
+            pass
+
+class EmailWorkerPool(PerProcess):
+    def __init__(self, size, poll_seconds=15):
+        self.size = size
+        self.poll_seconds = poll_seconds
+        self.wake = Event()
+
+    def start(self):
+        if self.size > 0:
+            self.ensure_started()
+
+    def _start(self):
+        for _ in range(self.size):
+            Thread(target=self._run, daemon=True).start()
+        self.wake.set()  # emails left over from before a restart go out right away
+
+    def wake_up(self):
+        self.start()
+        self.wake.set()
+
+    def _run(self):
+        while True:
+            self.wake.wait(self.poll_seconds)
+            self.wake.clear()
+            try:
+                drain_outbox()
+            except Exception as e:
+                print(f"Email worker error: {e}")
+
+email_pool = EmailWorkerPool(app.config['MAIL_WORKERS'])
+
+@app.before_request
+def start_email_pool():
+    # A worker that only ever serves pages still sends (and retries) what the others queued
+    email_pool.start()
+
+
+# --- PDF INVOICES ---
+# pisa is CPU-bound and slow, so checkout only renders the (cheap) HTML and hands
+# it to a process pool. The PDF is cached on disk per order and reused for every
+# resend and download; the email goes out once the file exists.
+app.config['INVOICE_DIR'] = os.environ.get('INVOICE_DIR', os.path.join(app.instance_path, 'invoices'))
+app.config['INVOICE_PROCESSES'] = int(os.environ.get('INVOICE_PROCESSES', 2))  # 0 = render inline (tests)
+
+def invoice_path(order_id):
+    return os.path.join(app.config['INVOICE_DIR'], f"invoice_{order_id}.pdf")
+
+def atomic_write(path, data):
+    """Write under a temp name, then rename, so a half-written file is never served."""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+def render_invoice_pdf(html_content, path):
+    # Runs inside the process pool, so it must only touch its arguments
+    pdf_buffer = BytesIO()
+    pisa_status = pisa.CreatePDF(html_content, dest=pdf_buffer)
+    if pisa_status.err:
+        raise RuntimeError(f"PDF Generation failed: {pisa_status.err}")
+    atomic_write(path, pdf_buffer.getvalue())
+    return path
+
+class InvoicePool(PerProcess):
+    def __init__(self, size):
+        self.size = size
+        self.executor = None
+        self.in_flight = set()
+
+    def _start(self):
+        os.makedirs(app.config['INVOICE_DIR'], exist_ok=True)
+        self.executor = None
+        self.in_flight = set()
+
+    def submit(self, order_id, html_content, callback):
+        self.ensure_started()
+        self.in_flight.add(order_id)
+        if self.size <= 0:
+            future = Future()
+            try:
+                future.set_result(render_invoice_pdf(html_content, invoice_path(order_id)))
+            except Exception as e:
+                future.set_exception(e)
+            callback(future)
+            return
+
+        error = None
+        for attempt in range(2):
+            try:
+                if self.executor is None:
+                    self.executor = ProcessPoolExecutor(max_workers=self.size)
+                future = self.executor.submit(render_invoice_pdf, html_content, invoice_path(order_id))
+            except BrokenProcessPool as e:
+                # A child died (OOM, segfault) and took the whole pool with it: start a new one
+                self.executor.shutdown(wait=False)
+                self.executor = None
+                error = e
+                continue
+            except Exception as e:
+                error = e
+                break
+            future.add_done_callback(callback)
+            return
+        # Report it like a failed render instead of raising: the callback takes the order
+        # out of in_flight and marks it 'failed', so the next download request retries
+        failed = Future()
+        failed.set_exception(error)
+        callback(failed)
+
+invoice_pool = InvoicePool(app.config['INVOICE_PROCESSES'])
+
+def request_invoice(order, user, email_to=None):
+    """Make sure order has a cached PDF, optionally emailing it to email_to=(email, name).
+    The caller commits; rendering starts once that commit lands."""
+    if os.path.exists(invoice_path(order.id)):
+        if email_to:
+            email_invoice(order.id, *email_to)
+        return
+
+    html_content = render_template('invoice.html', order=order, user=user)
+    order.invoice_status = 'pending'
+    after_commit(partial(invoice_pool.submit, order.id, html_content, partial(invoice_finished, order.id, email_to)))
+
+def invoice_finished(order_id, email_to, future):
+    # Called on the pool's result thread once the PDF is written (or failed)
+    invoice_pool.in_flight.discard(order_id)
+    error = future.exception()
+    with app.app_context():
+        order = db.session.get(Order, order_id)
+        order.invoice_status = 'failed' if error else 'ready'
+        if error:
+            print(f"❌ ERROR: Invoice for order #{order_id} failed: {error}")
+        elif email_to:
+            email_invoice(order_id, *email_to)
+        db.session.commit()
+
+def email_invoice(order_id, user_email, user_name):
+    msg = Message(f'Invoice - Order #{order_id}', 
+                  sender=app.config['MAIL_USERNAME'], 
+                  recipients=[user_email])
+    msg.body = f"Hello {user_name},\n\nThank you for your purchase. Please find your invoice attached.\n\nBest,\nThe Fake Shop Team"
+    with open(invoice_path(order_id), 'rb') as f:
+        msg.attach(f"Invoice_{order_id}.pdf", "application/pdf", f.read())
+    queue_email(msg)
 
 
 def send_reset_email(user):
@@ -308,7 +1428,7 @@ def send_reset_email(user):
 If you did not make this request then simply ignore this email and no changes will be made.
 '''
     # mail.send(msg)
-    Thread(target=send_async_email, args=(app, msg)).start()
+    queue_email(msg)
 
 def send_order_confirmation_email_messege(user_email,user_name, order):
     msg = Message(f'Order Confirmation - #{order.id}', 
@@ -336,24 +1456,12 @@ Thank you for shopping with The Fake Shop!
 '''
     # 2. Send it (Async is better, but this works for now)
     # mail.send(msg)
-    Thread(target=send_async_email, args=(app, msg)).start()
+    queue_email(msg)
 
 
 def send_order_confirmation_email_pdf(user_email, user_name, user_obj,order):
-    msg = Message(f'Invoice - Order #{order.id}', 
-                  sender=app.config['MAIL_USERNAME'], 
-                  recipients=[user_email])
-    msg.body = f"Hello {user_name},\n\nThank you for your purchase. Please find your invoice attached.\n\nBest,\nThe Fake Shop Team"
-    html_content = render_template('invoice.html', order=order, user=user_obj)
-    pdf_buffer = BytesIO()
-    pisa_status = pisa.CreatePDF(html_content, dest=pdf_buffer)
-    if pisa_status.err:
-        print(f"❌ ERROR: PDF Generation failed: {pisa_status.err}")
-        return # Abort sending if PDF fails
-    pdf_buffer.seek(0)
-    msg.attach(f"Invoice_{order.id}.pdf", "application/pdf", pdf_buffer.read())
-    # mail.send(msg)
-    Thread(target=send_async_email, args=(app, msg)).start()
+    # Rendering happens in the invoice pool, the email is queued when the PDF is ready
+    request_invoice(order, user_obj, email_to=(user_email, user_name))
 
 
 def send_shipped_email(user, order):
@@ -373,7 +1481,7 @@ You will receive your items shortly.
 Thank you for shopping with The Fake Shop!
 '''
     # mail.send(msg)
-    Thread(target=send_async_email, args=(app, msg)).start()
+    queue_email(msg)
 
 def send_cancel_email(user, order_id, total_price):
     msg = Message(f'Order #{order_id} Cancelled', 
@@ -391,7 +1499,7 @@ The refund will be processed within 3-5 business days.
 Thank you for shopping with The Fake Shop!
 '''
     # mail.send(msg)
-    Thread(target=send_async_email, args=(app, msg)).start()
+    queue_email(msg)
 
 def send_admin_alert(order):
     # 1. Get the Admin User (ID #1)
@@ -406,7 +1514,7 @@ def send_admin_alert(order):
 Order ID: {order.id}
 Customer: {order.customer.name} ({order.customer.email})
 Total: ${"%.2f" % (order.total_price / 100)}
-Date: {order.date}
+Date: {order.date:%Y-%m-%d %H:%M}
 
 Items:
 '''
@@ -416,7 +1524,885 @@ Items:
     msg.body += "\nLogin to your dashboard to ship this order."
     
     # mail.send(msg)
-    Thread(target=send_async_email, args=(app, msg)).start()
+    queue_email(msg)
+
+# --- SHARED CACHE ---
+# Redis when REDIS_URL is set (shared by every worker), otherwise a dict per
+# worker. Callers must treat every value as a hint: a miss or a Redis outage
+# just means "go ask the database".
+class LocalCache:
+    def __init__(self):
+        self.data = {}
+        self.lock = Lock()
+
+    def get(self, key):
+        with self.lock:
+            value, expires = self.data.get(key, (None, None))
+            if expires is not None and expires < time():
+                self.data.pop(key, None)
+                return None
+            return value
+
+    def set(self, key, value, ttl=None):
+        with self.lock:
+            self.data[key] = (str(value), time() + ttl if ttl else None)
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+class RedisCache:
+    def __init__(self, url):
+        self.client = redis.Redis.from_url(url, socket_timeout=0.5, decode_responses=True)
+
+    def get(self, key):
+        try:
+            return self.client.get(key)
+        except redis.RedisError as e:
+            print(f"Cache get failed: {e}")
+            return None
+
+    def set(self, key, value, ttl=None):
+        try:
+            self.client.set(key, value, ex=ttl)
+        except redis.RedisError as e:
+            print(f"Cache set failed: {e}")
+
+    def delete(self, key):
+        try:
+            self.client.delete(key)
+        except redis.RedisError as e:
+            print(f"Cache delete failed: {e}")
+
+if app.config['REDIS_URL'] and redis is not None:
+    cache = RedisCache(app.config['REDIS_URL'])
+else:
+    cache = LocalCache()
+
+
+# --- PENDING ORDERS COUNTER ---
+# The admin navbar badge used to run a COUNT(*) on every render. It is now cached
+# for a short TTL and dropped whenever an order enters or leaves 'Pending'.
+PENDING_COUNT_KEY = 'pending_orders_count'
+PENDING_COUNT_TTL = int(os.environ.get('PENDING_COUNT_TTL', 30))
+
+def get_pending_count():
+    cached = cache.get(PENDING_COUNT_KEY)
+    if cached is not None:
+        return int(cached)
+    count = db.session.execute(
+        db.select(func.count(Order.id)).where(Order.status == 'Pending')
+    ).scalar()
+    cache.set(PENDING_COUNT_KEY, count, ttl=PENDING_COUNT_TTL)
+    return count
+
+def invalidate_pending_count():
+    # Only after the commit lands, or another request could re-cache the old number
+    after_commit(partial(cache.delete, PENDING_COUNT_KEY))
+
+
+# --- CATALOG FRAGMENT CACHE ---
+# The product grid on the home page only changes when a product or a rating does,
+# so the rendered HTML is kept per (version, viewer, q, sort, page). The version
+# is a row in the database, bumped in the same transaction as the change, so every
+# process sees it (other web workers, `flask catalog import`...). Workers cache it
+# for CATALOG_VERSION_TTL seconds; a bump makes their old fragments unreachable
+# and the LRU ages them out.
+CATALOG_VERSION_KEY = 'catalog_version'
+CATALOG_VERSION_TTL = float(os.environ.get('CATALOG_VERSION_TTL', 2))
+catalog_version_table = db.Table('catalog_version',
+    db.Column('id', db.Integer, primary_key=True),
+    db.Column('version', db.BigInteger, nullable=False),
+)
+FRAGMENT_CACHE_BYTES = int(os.environ.get('FRAGMENT_CACHE_BYTES', 8 * 1024 * 1024))
+
+class FragmentCache:
+    """Per-worker LRU of rendered HTML, capped by total size in bytes."""
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+
+    def get(self, key):
+        with self.lock:
+            html = self.entries.get(key)
+            if html is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return html
+
+    def set(self, key, html):
+        cost = len(html.encode('utf-8'))
+        if cost > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old.encode('utf-8'))
+            self.entries[key] = html
+            self.size += cost
+            # Evict least recently used until we are back under the cap
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted.encode('utf-8'))
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(100 * self.hits / lookups, 1) if lookups else 0,
+                'entries': len(self.entries),
+                'kb': round(self.size / 1024, 1),
+                'max_kb': round(self.max_bytes / 1024),
+            }
+
+fragment_cache = FragmentCache(FRAGMENT_CACHE_BYTES)
+
+def get_catalog_version():
+    version = cache.get(CATALOG_VERSION_KEY)
+    if version is None:
+        version = db.session.execute(db.select(catalog_version_table.c.version)).scalar() or 0
+        cache.set(CATALOG_VERSION_KEY, version, ttl=CATALOG_VERSION_TTL)
+    return str(version)
+
+def catalog_version_update():
+    return catalog_version_table.update().where(catalog_version_table.c.id == 1).values(version=time_ns())
+
+def invalidate_catalog(connection):
+    """Bump the version inside the caller's transaction (mapper events pass their connection)."""
+    connection.execute(catalog_version_update())
+    # This worker (every worker, with Redis) stops using the old one as soon as the commit lands
+    after_commit(partial(cache.delete, CATALOG_VERSION_KEY))
+
+def bump_catalog_version():
+    """For bulk paths that skip the ORM events (catalog import, backfills)."""
+    db.session.execute(catalog_version_update())
+    db.session.commit()
+    cache.delete(CATALOG_VERSION_KEY)
+
+@event.listens_for(Product, 'after_insert')
+@event.listens_for(Product, 'after_update')
+@event.listens_for(Product, 'after_delete')
+def product_changed(mapper, connection, product):
+    invalidate_catalog(connection)
+
+
+# --- IMAGE PIPELINE ---
+# Uploads are resized once, at upload time, into a few widths, each saved as
+# JPEG and WebP. Templates pick a variant through srcset. Before this, every
+# card loaded the same 800px Cloudinary URL.
+# Variants go through a storage backend: the local filesystem (the default,
+# no account needed), Cloudinary when it is configured, or memory for tests.
+IMAGE_SIZES = {'thumb': 240, 'card': 480, 'detail': 1200}  # name -> max width in px
+IMAGE_FORMATS = {'jpg': ('JPEG', {'quality': 80, 'optimize': True, 'progressive': True}),
+                 'webp': ('WEBP', {'quality': 75, 'method': 4})}
+WATERMARK_TEXT = "FAKE SHOP"
+
+app.config['IMAGE_BACKEND'] = os.environ.get('IMAGE_BACKEND', 'cloudinary' if os.environ.get('CLOUDINARY_CLOUD_NAME') else 'local')
+app.config['IMAGE_DIR'] = os.environ.get('IMAGE_DIR', os.path.join(app.instance_path, 'images'))
+IMAGE_URL_PREFIX = '/images'
+
+def variant_path(key, size, ext):
+    return f"products/{key}/{size}.{ext}"
+
+def is_cloudinary_url(url):
+    return bool(url) and "cloudinary" in url and "/upload/" in url
+
+def legacy_image_url(url, width, ext='jpg', watermark=False):
+    """Older rows only have an image_url; Cloudinary can still resize those on the fly."""
+    if not is_cloudinary_url(url):
+        return url
+    transformation = f"w_{width},c_limit"
+    if watermark:
+        transformation += f"/l_text:Arial_{max(width // 16, 12)}_bold:FAKE%20SHOP,co_rgb:FFFFFF,o_40,g_south_east,x_20,y_20"
+    if ext == 'webp':
+        transformation += "/f_webp"
+    parts = url.split("/upload/", 1)
+    return f"{parts[0]}/upload/{transformation}/{parts[1]}"
+
+def draw_watermark(img):
+    draw = ImageDraw.Draw(img, 'RGBA')
+    try:
+        font = ImageFont.load_default(size=max(img.width // 16, 12))
+    except TypeError:
+        font = ImageFont.load_default()  # Pillow < 10.1 only has the fixed-size bitmap font
+    left, top, right, bottom = draw.textbbox((0, 0), WATERMARK_TEXT, font=font)
+    margin = max(img.width // 40, 4)
+    position = (img.width - (right - left) - margin, img.height - (bottom - top) - margin * 2)
+    draw.text(position, WATERMARK_TEXT, font=font, fill=(255, 255, 255, 102))
+
+def build_image_variants(file, watermark=False):
+    """Resize an uploaded image into every size and format: {(size, ext): bytes}."""
+    with Image.open(file) as original:
+        # Phones store rotation in EXIF; bake it in before we throw the metadata away
+        original = ImageOps.exif_transpose(original).convert('RGB')
+    variants = {}
+    for size, width in IMAGE_SIZES.items():
+        img = original.copy()
+        if img.width > width:
+            img = img.resize((width, round(img.height * width / img.width)), Image.LANCZOS)
+        if watermark:
+            draw_watermark(img)
+        for ext, (pil_format, options) in IMAGE_FORMATS.items():
+            buffer = BytesIO()
+            img.save(buffer, pil_format, **options)
+            variants[(size, ext)] = buffer.getvalue()
+    return variants
+
+class LocalImageStorage:
+    def __init__(self, root):
+        self.root = root
+
+    def save(self, path, data):
+        full_path = os.path.join(self.root, path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        atomic_write(full_path, data)
+
+    def url(self, path):
+        # Plain string, so upload workers can build it without a request
+        return f"{IMAGE_URL_PREFIX}/{path}"
+
+class CloudinaryImageStorage:
+    def save(self, path, data):
+        public_id, ext = path.rsplit('.', 1)
+        cloudinary.uploader.upload(data, public_id=public_id, format=ext, overwrite=True)
+
+    def url(self, path):
+        public_id, ext = path.rsplit('.', 1)
+        return cloudinary.CloudinaryImage(public_id).build_url(format=ext, secure=True)
+
+class MemoryImageStorage:
+    # Fake backend for tests: keeps the bytes and can be told to fail the next N saves
+    def __init__(self):
+        self.files = {}
+        self.fail_next = 0
+        self.lock = Lock()
+
+    def save(self, path, data):
+        with self.lock:
+            if self.fail_next > 0:
+                self.fail_next -= 1
+                raise ConnectionError("simulated storage outage")
+            self.files[path] = data
+
+    def url(self, path):
+        return f"memory://{path}"
+
+def make_image_storage(backend):
+    if backend == 'cloudinary':
+        return CloudinaryImageStorage()
+    if backend == 'memory':
+        return MemoryImageStorage()
+    return LocalImageStorage(app.config['IMAGE_DIR'])
+
+image_storage = make_image_storage(app.config['IMAGE_BACKEND'])
+
+def save_image_variants(key, file, watermark=False):
+    """Run an image through the pipeline and upload every variant. Returns the detail JPEG url."""
+    for (size, ext), data in build_image_variants(file, watermark).items():
+        image_storage.save(variant_path(key, size, ext), data)
+    return image_storage.url(variant_path(key, 'detail', 'jpg'))
+
+@app.route(f'{IMAGE_URL_PREFIX}/<path:path>')
+def image_file(path):
+    # Keys are never reused, so a variant can be cached forever
+    response = send_from_directory(app.config['IMAGE_DIR'], path, max_age=365 * 24 * 3600)
+    response.cache_control.immutable = True
+    return response
+
+
+# --- BACKGROUND UPLOADS ---
+# Resizing and pushing six variants to the storage backend used to hold the request
+# (and the gunicorn worker) for seconds. Now the request only checks that the file
+# is an image, drops it in a staging folder and saves the row with a placeholder.
+# After the commit, a small thread pool builds and uploads the variants with
+# retries. The row's image_status is cleared when the real image is live.
+app.config['UPLOAD_STAGING_DIR'] = os.environ.get('UPLOAD_STAGING_DIR', os.path.join(app.instance_path, 'staging'))
+app.config['UPLOAD_WORKERS'] = int(os.environ.get('UPLOAD_WORKERS', 2))  # 0 = process inline (tests)
+UPLOAD_MAX_ATTEMPTS = int(os.environ.get('UPLOAD_MAX_ATTEMPTS', 4))
+UPLOAD_BACKOFF_SECONDS = float(os.environ.get('UPLOAD_BACKOFF_SECONDS', 2))
+IMAGE_PLACEHOLDER = '/static/placeholder.svg'
+MAX_GALLERY_UPLOAD = 20
+
+def staging_path(key):
+    return os.path.join(app.config['UPLOAD_STAGING_DIR'], key)
+
+class NotAnImageError(ValueError):
+    pass
+
+def stage_upload(file):
+    """Check that file is an image and park it for the upload workers. Returns the new image key.
+    Raises NotAnImageError for anything Pillow can't read (wrong type, truncated, corrupt, a bomb)."""
+    data = file.read()
+    # verify() only parses the headers, so this stays cheap even for big photos
+    try:
+        with Image.open(BytesIO(data)) as img:
+            img.verify()
+    except (UnidentifiedImageError, OSError, SyntaxError, Image.DecompressionBombError) as e:
+        raise NotAnImageError(str(e)) from e
+    key = uuid4().hex
+    os.makedirs(app.config['UPLOAD_STAGING_DIR'], exist_ok=True)
+    atomic_write(staging_path(key), data)
+    return key
+
+def attach_staged_image(row, key):
+    """Point row (a Product or ProductImage) at a staged upload. The caller commits."""
+    row.image_key = key
+    row.image_status = 'pending'
+    row.image_url = IMAGE_PLACEHOLDER
+    db.session.flush()  # we need the id for the worker
+    after_commit(partial(upload_pool.submit, type(row).__name__, row.id))
+
+def process_staged_image(model_name, row_id):
+    model = {'Product': Product, 'ProductImage': ProductImage}[model_name]
+    with app.app_context():
+        row = db.session.get(model, row_id)
+        if row is None or row.image_status != 'pending':
+            return  # deleted, or replaced by a newer upload meanwhile
+        key = row.image_key
+        path = staging_path(key)
+
+        for attempt in range(1, UPLOAD_MAX_ATTEMPTS + 1):
+            try:
+                with open(path, 'rb') as f:
+                    url = save_image_variants(key, f, row.watermark)
+                break
+            except (UnidentifiedImageError, FileNotFoundError) as e:
+                # Retrying won't fix a bad or missing file
+                give_up, error = True, e
+            except Exception as e:
+                give_up, error = attempt == UPLOAD_MAX_ATTEMPTS, e
+            if give_up:
+                print(f"Image upload {key} failed for good: {error}")
+                row.image_status = 'failed'
+                db.session.commit()
+                return
+            print(f"Image upload {key} failed (attempt {attempt}): {error}")
+            sleep(UPLOAD_BACKOFF_SECONDS * 2 ** (attempt - 1))
+
+        # Only flip the row if nobody swapped in another upload while we worked
+        db.session.refresh(row)
+        if row.image_key == key:
+            row.image_url = url
+            row.image_status = None
+            db.session.commit()
+        os.remove(path)
+
+class UploadWorkerPool(PerProcess):
+    def __init__(self, size):
+        self.size = size
+        self.queue = None
+
+    def _start(self):
+        self.queue = Queue()
+        for _ in range(self.size):
+            Thread(target=self._run, daemon=True).start()
+
+    def submit(self, model_name, row_id):
+        if self.size <= 0:
+            process_staged_image(model_name, row_id)
+            return
+        self.ensure_started()
+        self.queue.put((model_name, row_id))
+
+    def _run(self):
+        while True:
+            model_name, row_id = self.queue.get()
+            try:
+                process_staged_image(model_name, row_id)
+            except Exception as e:
+                print(f"Upload worker error: {e}")
+            finally:
+                self.queue.task_done()
+
+upload_pool = UploadWorkerPool(app.config['UPLOAD_WORKERS'])
+
+@app.cli.command('retry-uploads')
+def retry_uploads():
+    """Re-run staged uploads that are still pending (e.g. after a restart) or that failed."""
+    retried = 0
+    for model in (Product, ProductImage):
+        rows = db.session.execute(
+            db.select(model.id).where(model.image_status.in_(['pending', 'failed']))
+        ).scalars().all()
+        for row_id in rows:
+            db.session.execute(db.update(model).where(model.id == row_id).values(image_status='pending'))
+            db.session.commit()
+            process_staged_image(model.__name__, row_id)
+            retried += 1
+    print(f"✅ Retried {retried} uploads.")
+
+
+# --- CATALOG IMPORT / EXPORT ---
+# `flask catalog import products.csv` / `flask catalog export products.jsonl`
+# Rows are matched on a stable SKU, so re-importing the same file updates in place.
+# Files are streamed in batches: SQLite gets one multi-row upsert per batch,
+# Postgres COPYs each batch into a temp table and upserts from there.
+# Prices are in cents, the same as the product table.
+CATALOG_FIELDS = ['sku', 'title', 'price', 'description', 'image_url']
+CATALOG_UPDATE_FIELDS = ['title', 'price', 'description', 'image_url', 'updated_at']
+CATALOG_LENGTH_LIMITS = {field: Product.__table__.c[field].type.length
+                         for field in ('sku', 'title', 'description', 'image_url')}
+
+def catalog_format(filename, fmt):
+    if fmt:
+        return fmt
+    return 'jsonl' if filename.endswith(('.jsonl', '.ndjson')) else 'csv'
+
+def read_catalog(file, fmt):
+    """Yield (line number, raw dict) for every record in a CSV or JSONL stream."""
+    if fmt == 'jsonl':
+        for line_no, line in enumerate(file, start=1):
+            if line.strip():
+                yield line_no, json.loads(line)
+    else:
+        # Line 1 is the header
+        for line_no, record in enumerate(csv.DictReader(file), start=2):
+            yield line_no, record
+
+def clean_catalog_row(record):
+    """Validate one record; returns a row for the product table or raises ValueError."""
+    sku = str(record.get('sku') or '').strip()
+    title = str(record.get('title') or '').strip()
+    if not sku:
+        raise ValueError("missing sku")
+    if not title:
+        raise ValueError("missing title")
+    price = record.get('price')
+    try:
+        if isinstance(price, float) and not price.is_integer():
+            raise ValueError
+        price = int(price)
+    except (TypeError, ValueError):
+        raise ValueError(f"price must be a whole number of cents, got {price!r}")
+    row = {
+        'sku': sku,
+        'title': title,
+        'price': price,
+        'description': str(record.get('description') or '').strip(),
+        'image_url': str(record.get('image_url') or '').strip() or IMAGE_PLACEHOLDER,
+    }
+    for field, limit in CATALOG_LENGTH_LIMITS.items():
+        if len(row[field]) > limit:
+            raise ValueError(f"{field} is longer than {limit} characters")
+    return row
+
+def pause_search_triggers():
+    # If the import dies before resume_search_triggers(), repair_search_triggers()
+    # (run by upgrade-db and by the next import) puts them back
+    for trigger in FTS_TRIGGERS:
+        db.session.execute(text(f"DROP TRIGGER IF EXISTS {trigger}"))
+    db.session.commit()
+
+def resume_search_triggers():
+    db.session.execute(text(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')"))
+    setup_search_index()  # recreates the triggers and commits
+
+def repair_search_triggers():
+    """Recreate the FTS triggers (and re-index) if a killed import left them dropped. True if it had to."""
+    if current_search_backend() != 'fts5':
+        return False
+    found = db.session.execute(
+        text("SELECT count(*) FROM sqlite_master WHERE type = 'trigger' AND name IN :names")
+        .bindparams(db.bindparam('names', expanding=True)),
+        {'names': list(FTS_TRIGGERS)}
+    ).scalar()
+    if found == len(FTS_TRIGGERS):
+        return False
+    resume_search_triggers()
+    return True
+
+def upsert_products_sqlite(rows, now):
+    # Straight to the driver: SQLAlchemy's per-row parameter processing would cost
+    # more than SQLite itself. DateTime columns are stored as this text format.
+    stamp = now.strftime('%Y-%m-%d %H:%M:%S.%f')
+    columns = ', '.join(CATALOG_FIELDS + ['updated_at'])
+    updates = ', '.join(f"{field} = excluded.{field}" for field in CATALOG_UPDATE_FIELDS)
+    db.session.connection().exec_driver_sql(
+        f"INSERT INTO product ({columns}, rating_sum, rating_count) VALUES (?, ?, ?, ?, ?, ?, 0, 0) "
+        f"ON CONFLICT (sku) DO UPDATE SET {updates}",
+        [(row['sku'], row['title'], row['price'], row['description'], row['image_url'], stamp) for row in rows]
+    )
+
+def upsert_products_postgres(rows, now):
+    # COPY is by far the fastest way in; ON CONFLICT can't read from COPY directly,
+    # so the batch lands in a temp table first
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerows([row[field] for field in CATALOG_FIELDS] for row in rows)
+    buffer.seek(0)
+
+    columns = ', '.join(CATALOG_FIELDS)
+    updates = ', '.join(f"{field} = EXCLUDED.{field}" for field in CATALOG_UPDATE_FIELDS)
+    cursor = db.session.connection().connection.cursor()
+    cursor.execute(f"CREATE TEMP TABLE product_import ON COMMIT DROP AS SELECT {columns} FROM product WITH NO DATA")
+    cursor.copy_expert(f"COPY product_import ({columns}) FROM STDIN WITH (FORMAT csv)", buffer)
+    cursor.execute(f"INSERT INTO product ({columns}, updated_at, rating_sum, rating_count) "
+                   f"SELECT {columns}, %s, 0, 0 FROM product_import "
+                   f"ON CONFLICT (sku) DO UPDATE SET {updates}", (now,))
+
+def upsert_products_generic(rows, now):
+    # Anything else: one query to split the batch, then bulk UPDATE by id and bulk INSERT
+    existing = dict(db.session.execute(
+        db.select(Product.sku, Product.id).where(Product.sku.in_([row['sku'] for row in rows]))
+    ).all())
+    updates = [{'id': existing[row['sku']], 'updated_at': now, **row} for row in rows if row['sku'] in existing]
+    inserts = [{'updated_at': now, **row} for row in rows if row['sku'] not in existing]
+    if updates:
+        db.session.execute(db.update(Product), updates)
+    if inserts:
+        db.session.execute(db.insert(Product), inserts)
+
+def assign_missing_skus():
+    """Give products made through the admin form a stable SKU, 'FS-<id>', unless an import
+    already uses that one ('FS-<id>-2', -3... then). The caller commits. Returns how many."""
+    taken = Product.__table__.alias('taken')
+    default_sku = 'FS-' + cast(Product.id, String)
+    assigned = db.session.execute(
+        db.update(Product)
+        .where(Product.sku.is_(None), ~db.select(taken.c.id).where(taken.c.sku == default_sku).exists())
+        .values(sku=default_sku)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    # Only the collisions are left, one by one
+    for product_id in db.session.execute(db.select(Product.id).where(Product.sku.is_(None))).scalars().all():
+        n = 2
+        while db.session.execute(db.select(Product.id).where(Product.sku == f'FS-{product_id}-{n}')).first():
+            n += 1
+        db.session.execute(
+            db.update(Product).where(Product.id == product_id).values(sku=f'FS-{product_id}-{n}')
+            .execution_options(synchronize_session=False)
+        )
+        assigned += 1
+    return assigned
+
+def upsert_products(rows, now):
+    dialect = db.engine.dialect.name
+    if dialect == 'sqlite':
+        upsert_products_sqlite(rows, now)
+    elif dialect == 'postgresql':
+        upsert_products_postgres(rows, now)
+    else:
+        upsert_products_generic(rows, now)
+
+@app.cli.group()
+def catalog():
+    """Bulk product import/export (CSV or JSONL)."""
+
+@catalog.command('import')
+@click.argument('file', type=click.File('r', encoding='utf-8'))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']), help='Default: from the file extension.')
+@click.option('--batch-size', default=5000, help='Rows per upsert/transaction.')
+def catalog_import(file, fmt, batch_size):
+    """Create or update products from FILE ('-' for stdin), matched by SKU."""
+    fmt = catalog_format(file.name, fmt)
+    start = perf_counter()
+    imported = 0
+    rejected = 0
+    written = set()  # distinct SKUs upserted (a SKU repeated in the file is one product)
+
+    if repair_search_triggers():
+        print("🔎 The search triggers were missing (an earlier import was interrupted): recreated them and re-indexed.")
+    batches = 0
+    paused_search_index = False
+
+    def flush(batch):
+        nonlocal batches, paused_search_index
+        if batches == 1 and current_search_backend() == 'fts5':
+            # More than one batch: indexing everything once at the end is ~7x faster
+            # than the per-row FTS triggers
+            pause_search_triggers()
+            paused_search_index = True
+        # Duplicate SKUs in one statement would trip ON CONFLICT: the last one wins
+        upsert_products(list(batch.values()), now)
+        db.session.commit()
+        written.update(batch)
+        batch.clear()
+        batches += 1
+
+    batch = {}
+    now = datetime.now()
+    try:
+        for line_no, record in read_catalog(file, fmt):
+            try:
+                row = clean_catalog_row(record)
+            except ValueError as e:
+                rejected += 1
+                print(f"⚠️  Line {line_no}: {e}")
+                continue
+            batch[row['sku']] = row
+            imported += 1
+            if len(batch) >= batch_size:
+                flush(batch)
+                elapsed = perf_counter() - start
+                print(f"   ... {imported:,} rows ({imported / elapsed:,.0f} rows/sec)")
+        if batch:
+            flush(batch)
+    finally:
+        db.session.rollback()
+        if paused_search_index:
+            # Also picks up anything edited through the site while the triggers were off
+            print("🔎 Rebuilding the search index...")
+            resume_search_triggers()
+
+    # After the upserts, so products from the site never take a SKU this file uses
+    assigned = assign_missing_skus()
+    if assigned:
+        print(f"🏷️  Assigned SKUs to {assigned:,} products made through the site.")
+    # Core inserts skip the ORM events, so tell the page caches ourselves
+    bump_catalog_version()
+    elapsed = perf_counter() - start
+    duplicates = imported - len(written)
+    print(f"✅ Imported {len(written):,} products in {elapsed:.1f}s ({imported / max(elapsed, 1e-9):,.0f} rows/sec)"
+          + (f", {duplicates:,} repeated SKUs (last one wins)" if duplicates else "")
+          + (f", rejected {rejected:,}." if rejected else "."))
+
+@catalog.command('export')
+@click.argument('file', type=click.File('w', encoding='utf-8'))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']), help='Default: from the file extension.')
+@click.option('--batch-size', default=5000, help='Rows fetched per round trip.')
+def catalog_export(file, fmt, batch_size):
+    """Write every product to FILE ('-' for stdout) in the format import reads."""
+    fmt = catalog_format(file.name, fmt)
+    start = perf_counter()
+
+    columns = [getattr(Product, field) for field in CATALOG_FIELDS]
+    rows = db.session.execute(
+        db.select(*columns).order_by(Product.id).execution_options(yield_per=batch_size)
+    )
+    writer = None
+    if fmt == 'csv':
+        writer = csv.writer(file)
+        writer.writerow(CATALOG_FIELDS)
+    exported = 0
+    missing_sku = 0
+    for row in rows:
+        if writer:
+            writer.writerow(row)
+        else:
+            file.write(json.dumps(dict(zip(CATALOG_FIELDS, row))) + '\n')
+        exported += 1
+        if row.sku is None:
+            missing_sku += 1
+        if exported % (batch_size * 20) == 0:
+            elapsed = perf_counter() - start
+            print(f"   ... {exported:,} rows ({exported / elapsed:,.0f} rows/sec)", file=sys.stderr)
+
+    elapsed = perf_counter() - start
+    print(f"✅ Exported {exported:,} rows in {elapsed:.1f}s ({exported / max(elapsed, 1e-9):,.0f} rows/sec)", file=sys.stderr)
+    if missing_sku:
+        # Export only reads: the next `flask catalog import` assigns them
+        print(f"⚠️  {missing_sku:,} products have no SKU and would be rejected on re-import.", file=sys.stderr)
+
+
+# --- HTTP CACHING ---
+# Anonymous catalog and product pages carry an ETag and Last-Modified, so a browser,
+# CDN or reverse proxy can revalidate with a cheap 304 instead of a full render.
+# Logged-in pages have the user's name, cart and CSRF token in them: those are
+# marked private and never get validators.
+HTTP_CACHE_SECONDS = int(os.environ.get('HTTP_CACHE_SECONDS', 0))  # s-maxage for shared caches
+
+def template_fingerprint():
+    # A deploy that changes the markup must change the ETags too
+    digest = hashlib.sha1()
+    folder = os.path.join(app.root_path, app.template_folder)
+    for name in sorted(os.listdir(folder)):
+        with open(os.path.join(folder, name), 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+TEMPLATE_FINGERPRINT = template_fingerprint()
+
+def make_etag(*parts):
+    return hashlib.sha1(repr((TEMPLATE_FINGERPRINT,) + parts).encode()).hexdigest()[:32]
+
+def is_shareable():
+    """True when the page holds nothing specific to this visitor (no login, no pending flash)."""
+    return not current_user.is_authenticated and '_flashes' not in session
+
+def add_cache_headers(response, etag, last_modified=None, weak=False):
+    response.set_etag(etag, weak=weak)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    # Always revalidate; a shared cache may hold it for HTTP_CACHE_SECONDS
+    response.cache_control.public = True
+    response.cache_control.no_cache = True
+    if HTTP_CACHE_SECONDS:
+        response.cache_control.s_maxage = HTTP_CACHE_SECONDS
+    response.vary.add('Cookie')
+    return response
+
+def not_modified(etag, last_modified=None, weak=False):
+    """A 304 if the client already has this version, otherwise None."""
+    if is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        return None
+    return add_cache_headers(make_response('', 304), etag, last_modified, weak)
+
+def private_page(response):
+    response = make_response(response)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    response.vary.add('Cookie')
+    return response
+
+
+# --- CART STORE ---
+# Carts used to live in the signed session cookie, re-serialized on every request.
+# Each backend keys a cart by user id and changes one line per operation.
+# Changes follow the request's transaction: the caller commits.
+class DatabaseCartStore:
+    def items(self, user_id):
+        rows = db.session.execute(
+            db.select(CartItem.product_id, CartItem.quantity).where(CartItem.user_id == user_id)
+        ).all()
+        return {product_id: quantity for product_id, quantity in rows}
+
+    def add(self, user_id, product_id, quantity=1):
+        upsert_insert(CartItem, [{'user_id': user_id, 'product_id': product_id, 'quantity': quantity}],
+                      keys=['user_id', 'product_id'], add=['quantity'])
+
+    def remove(self, user_id, product_id):
+        db.session.execute(db.delete(CartItem).where(CartItem.user_id == user_id, CartItem.product_id == product_id))
+
+    def clear(self, user_id):
+        db.session.execute(db.delete(CartItem).where(CartItem.user_id == user_id))
+
+class RedisCartStore:
+    # One hash per user: cart:<user_id> -> {product_id: quantity}
+    def __init__(self, url):
+        self.client = redis.Redis.from_url(url, decode_responses=True)
+
+    def key(self, user_id):
+        return f"cart:{user_id}"
+
+    def items(self, user_id):
+        return {int(product_id): int(quantity) for product_id, quantity in self.client.hgetall(self.key(user_id)).items()}
+
+    def add(self, user_id, product_id, quantity=1):
+        self.client.hincrby(self.key(user_id), product_id, quantity)
+
+    def remove(self, user_id, product_id):
+        self.client.hdel(self.key(user_id), product_id)
+
+    def clear(self, user_id):
+        # Wait for the order to commit before emptying the cart
+        after_commit(partial(self.client.delete, self.key(user_id)))
+
+class MemoryCartStore:
+    # Per-process stand-in for tests and local hacking
+    def __init__(self):
+        self.carts = {}
+        self.lock = Lock()
+
+    def items(self, user_id):
+        with self.lock:
+            return dict(self.carts.get(user_id, {}))
+
+    def add(self, user_id, product_id, quantity=1):
+        with self.lock:
+            cart = self.carts.setdefault(user_id, {})
+            cart[product_id] = cart.get(product_id, 0) + quantity
+
+    def remove(self, user_id, product_id):
+        with self.lock:
+            self.carts.get(user_id, {}).pop(product_id, None)
+
+    def clear(self, user_id):
+        after_commit(partial(self._drop, user_id))
+
+    def _drop(self, user_id):
+        with self.lock:
+            self.carts.pop(user_id, None)
+
+def make_cart_store(backend):
+    if backend == 'redis':
+        if redis is None or not app.config['REDIS_URL']:
+            raise RuntimeError("CART_BACKEND=redis needs the redis package and REDIS_URL")
+        return RedisCartStore(app.config['REDIS_URL'])
+    if backend == 'memory':
+        return MemoryCartStore()
+    return DatabaseCartStore()
+
+cart_store = make_cart_store(app.config['CART_BACKEND'])
+
+@app.before_request
+def move_session_cart():
+    # Carts created before the server-side store still sit in old cookies: adopt them once
+    if 'cart' in session and current_user.is_authenticated:
+        for p_id, qty in session.pop('cart').items():
+            if p_id and p_id.isdigit():
+                cart_store.add(current_user.id, int(p_id), qty)
+        db.session.commit()
+
+
+# --- DAILY SALES ROLLUP ---
+# The dashboard used to SUM/COUNT/GROUP BY the whole order table on every load.
+# Checkout and cancel now adjust one daily_sales row inside their own transaction,
+# and the dashboard reads at most a year of rollup rows.
+def record_daily_sales(day, revenue_delta, orders_delta):
+    if isinstance(day, datetime):
+        day = day.date()
+    upsert_insert(DailySales, [{'day': day, 'revenue': revenue_delta, 'orders': orders_delta}],
+                  keys=['day'], add=['revenue', 'orders'])
+
+
+# --- DATES ---
+def parse_day(value):
+    """'YYYY-MM-DD' from a query string -> date, or None if blank/garbage."""
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    except (TypeError, ValueError):
+        return None
+
+def filter_by_day_range(stmt, column, start, end):
+    # Half-open range on the datetime column so the index can be used and 'end' is inclusive
+    start_day, end_day = parse_day(start), parse_day(end)
+    if start_day:
+        stmt = stmt.where(column >= datetime.combine(start_day, datetime.min.time()))
+    if end_day:
+        stmt = stmt.where(column < datetime.combine(end_day + timedelta(days=1), datetime.min.time()))
+    return stmt
+
+def hour_bucket(column):
+    """SQL expression truncating a datetime column to 'YYYY-MM-DD HH:00'."""
+    if db.engine.dialect.name == 'postgresql':
+        return func.to_char(func.date_trunc('hour', column), 'YYYY-MM-DD HH24:00')
+    return func.strftime('%Y-%m-%d %H:00', column)
+
+@app.template_filter('datefmt')
+def datefmt(value, fmt='%Y-%m-%d'):
+    return value.strftime(fmt) if value else ''
+
+
+# --- QUERY BUDGETS ---
+# Count the SQL statements each request runs. Views decorated with @query_budget(n)
+# complain when they go over, which catches templates that start lazy-loading.
+@event.listens_for(Engine, 'before_cursor_execute')
+def count_query(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and 'query_count' in g:
+        g.query_count += 1
+
+def query_budget(limit):
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            g.query_count = 0
+            response = f(*args, **kwargs)
+            if g.query_count > limit:
+                message = f"{f.__name__} ran {g.query_count} queries (budget {limit})"
+                if app.config['STRICT_QUERIES']:
+                    raise RuntimeError(message)
+                print(f"⚠️ {message}")
+            return response
+        return decorated_function
+    return decorator
 
 # This runs before EVERY template is rendered
 @app.context_processor
@@ -424,16 +2410,15 @@ def inject_pending_orders():
     pending_count = 0
     # Only check DB if user is logged in and is the Admin
     if current_user.is_authenticated and current_user.id == 1:
-        # Count orders where status is NOT 'Shipped' and NOT 'Cancelled'
-        pending_count = db.session.query(Order).filter(
-            Order.status == 'Pending'
-        ).count()
+        # Count orders where status is NOT 'Shipped' and NOT 'Cancelled' (cached, see above)
+        pending_count = get_pending_count()
     
     # This variable 'pending_orders_count' is now available in ALL html files
     return dict(pending_orders_count=pending_count)
 
 #HomePage
 @app.route("/")
+@read_replica
 def home():
     page = request.args.get('page', 1, type=int)
     search_query = request.args.get('q', '')
@@ -443,27 +2428,48 @@ def home():
     # --- NEW: THE SPY LOGIC ---
     if search_query:
         # 1. Clean the input (Lowercase to match "Shoe" with "shoe")
-        clean_term = search_query.strip().lower()
+        clean_term = search_query.strip().lower()[:100]
         
         if clean_term:
-            # 2. Check if term exists
-            # We use a separate DB session query to check existence
-            existing_term = db.session.execute(db.select(SearchTerm).where(SearchTerm.term == clean_term)).scalar()
-            
-            if existing_term:
-                existing_term.count += 1
-                existing_term.last_searched = datetime.now().strftime('%Y-%m-%d')
-            else:
-                new_term = SearchTerm(term=clean_term, last_searched=datetime.now().strftime('%Y-%m-%d'))
-                db.session.add(new_term)
-                
-            # 3. Commit (Save silently without slowing down the user)
-            db.session.commit()
+            # 2. Count it in memory, the buffer writes it out in bulk later
+            search_buffer.record(clean_term)
     
-    if search_query:
-        stmt = db.select(Product).where(Product.title.like(f'%{search_query}%'))
+    # The grid looks different for guests, shoppers and the admin, so each gets its own copy
+    if not current_user.is_authenticated:
+        viewer = 'guest'
+    elif current_user.id == 1:
+        viewer = 'admin'
     else:
-        stmt = db.select(Product)
+        viewer = 'customer'
+    version = get_catalog_version()
+    shareable = is_shareable()
+    if shareable:
+        # Listings change whenever anything in the catalog does, so they share one version
+        etag = make_etag('catalog', version, search_query, sort_option, page)
+        last_modified = datetime.fromtimestamp(int(version) / 1e9, timezone.utc)
+        cached_response = not_modified(etag, last_modified, weak=True)
+        if cached_response is not None:
+            return cached_response
+
+    fragment_key = (version, viewer, search_query.strip(), sort_option, page)
+    product_grid = fragment_cache.get(fragment_key)
+    if product_grid is None:
+        if time() - int(version) / 1e9 < REPLICA_LAG_SECONDS:
+            # Whatever renders now is cached for the whole version, and the replica
+            # may not have the change behind it yet
+            use_primary()
+        product_grid = render_product_grid(search_query, sort_option, page, per_page)
+        fragment_cache.set(fragment_key, product_grid)
+    html = render_template("index.html", product_grid=product_grid, current_sort=sort_option, search_query=search_query)
+    if shareable:
+        return add_cache_headers(make_response(html), etag, last_modified, weak=True)
+    return private_page(html)
+
+def render_product_grid(search_query, sort_option, page, per_page):
+    stmt = db.select(Product)
+    rank = None
+    if search_query:
+        stmt, rank = search_products(stmt, search_query)
     
     if sort_option == 'price_low':
         stmt = stmt.order_by(Product.price.asc())
@@ -473,40 +2479,14 @@ def home():
         stmt = stmt.order_by(Product.id.desc())
     elif sort_option == 'oldest':
         stmt = stmt.order_by(Product.id.asc())
+    elif rank is not None:
+        # No explicit sort while searching: best match first
+        stmt = stmt.order_by(rank, Product.id)
     else:
         stmt = stmt.order_by(Product.title)
     
     pagination = db.paginate(stmt, page=page, per_page=per_page, error_out=False)
-    return render_template("index.html", pagination=pagination, current_sort=sort_option, search_query=search_query)
-
-# @app.route('/add_deleted_flag')
-# def add_deleted_flag():
-#     try:
-#         # Add the column with a default of 0 (False)
-#         db.session.execute(text("ALTER TABLE user ADD COLUMN is_deleted BOOLEAN DEFAULT 0"))
-#         db.session.commit()
-#         return "Database updated! You can delete this route now."
-#     except Exception as e:
-#         return f"Error (Column might already exist): {e}"
-
-# @app.route('/init_coupons')
-# def init_coupons():
-#     try:
-#         # 1. Create Coupon Table
-#         db.create_all()
-        
-#         # 2. Add column to existing Order table
-#         db.session.execute(text("ALTER TABLE 'order' ADD COLUMN discount_amount INTEGER DEFAULT 0"))
-        
-#         # 3. Create a test coupon
-#         if not Coupon.query.filter_by(code="SAVE20").first():
-#             db.session.add(Coupon(code="SAVE20", discount=20))
-            
-#         db.session.commit()
-#         return "Coupons system initialized! 'SAVE20' is now valid."
-#     except Exception as e:
-#         return f"Database updated (or column already existed): {e}"
-
+    return render_template("_product_grid.html", pagination=pagination, search_query=search_query)
 
 @app.route('/delete_account')
 @login_required
@@ -599,9 +2579,14 @@ def add_product():
         # 1. Convert Price to Cents (Handling the math)
         price_in_cents = int(float(form.price.data) * 100)
         final_url=None
+        image_key=None
         if form.image_file.data:
-            upload_result = cloudinary.uploader.upload(form.image_file.data)
-            final_url = upload_result.get('secure_url')
+            try:
+                image_key = stage_upload(form.image_file.data)
+            except NotAnImageError:
+                flash("That file doesn't look like an image.","warning")
+                return render_template('add_product.html', form=form)
+            final_url = IMAGE_PLACEHOLDER  # swapped for the real image by the upload worker
             
         # PRIORITY 2: Did they paste a URL?
         elif form.image_url.data:
@@ -616,24 +2601,68 @@ def add_product():
             title=form.title.data,
             price=price_in_cents,
             description=form.description.data,
-            image_url=final_url
-            # We are defaulting stock to Infinite for now
+            image_url=final_url,
+            stock=form.stock.data,
         )
         
         # 3. Save to DB
         db.session.add(new_product)
+        if image_key:
+            attach_staged_image(new_product, image_key)
+        db.session.flush()
+        assign_missing_skus()  # so it can round-trip through catalog export/import
         db.session.commit()
         
         return redirect(url_for('home'))
     return render_template('add_product.html', form=form)
 
 #For admin only
+ADMIN_ORDERS_PER_PAGE = 50
+
 @app.route('/admin/orders')
 @admin_only  
+@read_replica
+@query_budget(5)
 def admin_orders():
-    # Fetch all orders, sorted by newest first (reverse ID order)
-    all_orders = db.session.execute(db.select(Order).order_by(Order.id.desc())).scalars().all()
-    return render_template('admin_orders.html', orders=all_orders)
+    # Filters: ?status=Pending&start=2025-01-01&end=2025-01-31&email=bob
+    status = request.args.get('status', '')
+    start = request.args.get('start', '')
+    end = request.args.get('end', '')
+    email = request.args.get('email', '').strip()
+    # Keyset cursors: ?before=<id> pages to older orders, ?after=<id> back to newer ones
+    before = request.args.get('before', type=int)
+    after = request.args.get('after', type=int)
+
+    stmt = db.select(Order).options(*Order.list_loads())
+    if status:
+        stmt = stmt.where(Order.status == status)
+    stmt = filter_by_day_range(stmt, Order.date, start, end)
+    if email:
+        stmt = stmt.where(Order.user_id.in_(db.select(User.id).where(User.email.ilike(f"%{email}%"))))
+
+    # Fetch one extra row to know whether another page exists. Seeking on the
+    # primary key costs the same on page 1 and page 10,000 (no OFFSET scan).
+    if after:
+        rows = db.session.execute(
+            stmt.where(Order.id > after).order_by(Order.id.asc()).limit(ADMIN_ORDERS_PER_PAGE + 1)
+        ).scalars().all()
+        has_newer = len(rows) > ADMIN_ORDERS_PER_PAGE
+        orders = list(reversed(rows[:ADMIN_ORDERS_PER_PAGE]))
+        has_older = True
+    else:
+        if before:
+            stmt = stmt.where(Order.id < before)
+        rows = db.session.execute(
+            stmt.order_by(Order.id.desc()).limit(ADMIN_ORDERS_PER_PAGE + 1)
+        ).scalars().all()
+        has_older = len(rows) > ADMIN_ORDERS_PER_PAGE
+        orders = rows[:ADMIN_ORDERS_PER_PAGE]
+        has_newer = bool(before)
+
+    # Only the active filters, so pager links stay clean
+    filters = {k: v for k, v in {'status': status, 'start': start, 'end': end, 'email': email}.items() if v}
+    return render_template('admin_orders.html', orders=orders, filters=filters,
+                           has_newer=has_newer and bool(orders), has_older=has_older and bool(orders))
 
 #For admin to manage order
 @app.route('/admin/ship-order/<int:order_id>')
@@ -647,11 +2676,13 @@ def ship_order(order_id):
             return redirect(url_for('admin_orders'))
         
         order.status = "Shipped" # Change the status
+        invalidate_pending_count()
         db.session.commit()
         # flash(f"Order #{order.id} has been marked as Shipped!")
         if order.customer:
             try:
                 send_shipped_email(order.customer, order)
+                db.session.commit()
                 flash(f"Order #{order.id} marked as Shipped and email sent to {order.customer.email}.", "success")
             except Exception as e:
                 flash(f"Order marked as Shipped, but email failed: {e}", "warning")
@@ -693,36 +2724,70 @@ def my_wishlist():
     stmt = db.select(Product).where(Product.id.in_(wishlist_ids))
     
     pagination = db.paginate(stmt, page=page, per_page=per_page, error_out=False)
-    return render_template("index.html", pagination=pagination, current_sort='', search_query='')
+    # Same cards as the catalog, but never fragment-cached (it's one user's list)
+    product_grid = render_template("_product_grid.html", pagination=pagination, search_query='',
+                                   page_endpoint='my_wishlist', empty_message='Your wishlist is empty.')
+    return render_template("index.html", product_grid=product_grid, current_sort='', search_query='')
+
+DASHBOARD_RANGES = {'7': 'Last 7 Days', '30': 'Last 30 Days', '365': 'Last 365 Days', 'all': 'All Time'}
+HOURLY_RANGE = '7'
 
 @app.route('/admin/dashboard')
 @admin_only
+@read_replica
 def admin_dashboard():
-    # 1. KPI: Total Revenue (Sum of all orders)
-    # scalar() gets a single number instead of a list
-    total_revenue_cents = db.session.query(func.sum(Order.total_price)).filter(Order.status != 'Cancelled').scalar() or 0
-    total_revenue = total_revenue_cents / 100
+    # ?range=7 / 30 / 365 days, or 'all' (every value reads the rollup, never the order table)
+    range_option = request.args.get('range', '30')
+    if range_option not in DASHBOARD_RANGES:
+        range_option = '30'
+    # ?granularity=hour is only offered for the 7 day window (168 points at most)
+    granularity = request.args.get('granularity', 'day')
+    if granularity != 'hour' or range_option != HOURLY_RANGE:
+        granularity = 'day'
+
+    stmt = db.select(DailySales).order_by(DailySales.day.asc())
+    if range_option != 'all':
+        first_day = datetime.now().date() - timedelta(days=int(range_option) - 1)
+        stmt = stmt.where(DailySales.day >= first_day)
+    daily_sales = db.session.execute(stmt).scalars().all()
+
+    # 1. KPI: Total Revenue (Sum of the daily rollups)
+    total_revenue = sum(day.revenue for day in daily_sales) / 100
     
     # 2. KPI: Total Orders (Count valid orders)
-    total_orders = Order.query.filter(Order.status != 'Cancelled').count()
+    total_orders = sum(day.orders for day in daily_sales)
     
     # 3. KPI: Average Order Value (AOV)
     avg_order_value = (total_revenue / total_orders) if total_orders > 0 else 0
     
     # 4. CHART DATA: Revenue over Time
-    # We group by 'date' and sum the total_price for that day
-    daily_sales = db.session.query(
-        Order.date, func.sum(Order.total_price)
-    ).filter(Order.status != 'Cancelled').group_by(Order.date).order_by(Order.date.asc()).all()
-    
     # Separate into two lists for the Chart (X-axis and Y-axis)
     dates = []
     sales = []
     
-    for day in daily_sales:
-        dates.append(day[0])          # e.g., "2026-01-08"
-        sales.append(day[1] / 100)    # e.g., 150.00
+    if granularity == 'hour':
+        # Hourly buckets come straight from the order table, but only for a short
+        # window, so it is a range scan on the Order.date index
+        bucket = hour_bucket(Order.date)
+        since = datetime.now() - timedelta(days=int(range_option))
+        hourly_sales = db.session.execute(
+            db.select(bucket, func.sum(Order.total_price))
+            .where(Order.date >= since, Order.status != 'Cancelled')
+            .group_by(bucket).order_by(bucket)
+        ).all()
+        for hour, revenue in hourly_sales:
+            dates.append(hour)                  # e.g., "2026-01-08 14:00"
+            sales.append((revenue or 0) / 100)
+    else:
+        for day in daily_sales:
+            if day.orders:
+                dates.append(day.day.isoformat())   # e.g., "2026-01-08"
+                sales.append(day.revenue / 100)     # e.g., 150.00
     
+    # Push this worker's buffered counts first so the panel is up to date, and read
+    # them back from where they just landed (the replica hasn't seen them yet)
+    search_buffer.flush()
+    use_primary()
     top_searches = db.session.execute(
         db.select(SearchTerm).order_by(SearchTerm.count.desc()).limit(5)
     ).scalars().all()
@@ -734,18 +2799,28 @@ def admin_dashboard():
                            avg_order=avg_order_value,
                            dates=json.dumps(dates),
                            sales=json.dumps(sales),
-                           top_searches=top_searches)
+                           top_searches=top_searches,
+                           current_range=range_option,
+                           ranges=DASHBOARD_RANGES,
+                           granularity=granularity,
+                           hourly_range=HOURLY_RANGE,
+                           fragment_stats=fragment_cache.stats())
 
 # Customer order page
 @app.route('/my-orders')
 @login_required
+@read_replica
+@query_budget(4)
 def my_orders():
-    # Only show orders for the CURRENT user
-    orders = current_user.orders 
+    # Only show orders for the CURRENT user, items loaded up front
+    orders = db.session.execute(
+        db.select(Order).options(*Order.detail_loads()).where(Order.user_id == current_user.id).order_by(Order.id)
+    ).scalars().all()
     return render_template('my_orders.html', orders=orders)
 
 #Seeing product detail
 @app.route('/product/<int:product_id>',methods=["GET","POST"])
+@read_replica
 def product_detail(product_id):
     # Fetch the single product
     product = db.get_or_404(Product, product_id)
@@ -754,25 +2829,35 @@ def product_detail(product_id):
     if not product:
         return redirect(url_for('home'))
     
-    form = ReviewForm()
-    if form.validate_on_submit():
-        if not current_user.is_authenticated:
-            flash("You need to login to leave a review!")
-            return redirect(url_for('login'))
-            
+    # Guests never see the review form, and building one would start a session just for its CSRF token
+    form = ReviewForm() if current_user.is_authenticated else None
+    if form is None and request.method == 'POST':
+        flash("You need to login to leave a review!")
+        return redirect(url_for('login'))
+
+    if form is not None and form.validate_on_submit():
         new_review = Review(
             rating=int(form.rating.data),
             text=form.text.data,
             product_id=product.id,
             user_id=current_user.id,
-            date_posted=datetime.now().strftime("%Y-%m-%d")
+            date_posted=datetime.now()
         )
         
         db.session.add(new_review)
         db.session.commit()
         flash("Review added successfully!","success")
         return redirect(url_for('product_detail', product_id=product.id))
-    return render_template('product_detail.html', product=product,form=form)
+
+    if request.method == 'GET' and is_shareable():
+        # Same bytes for every anonymous visitor until the product changes
+        etag = make_etag('product', product.id, product.updated_at)
+        cached_response = not_modified(etag, product.updated_at)
+        if cached_response is not None:
+            return cached_response
+        response = make_response(render_template('product_detail.html', product=product,form=form))
+        return add_cache_headers(response, etag, product.updated_at)
+    return private_page(render_template('product_detail.html', product=product,form=form))
 
 #Logout
 @app.route('/logout')
@@ -790,17 +2875,44 @@ def edit_product(product_id):
     form = AddProductForm(obj=product)
     
     if form.validate_on_submit():
+        # 0. Stock moves with every sale, so only write it if the admin changed it, and
+        #    only if it still holds what the form showed (otherwise sales made while the
+        #    form was open would be put back on the shelf)
+        original_stock = int(form.original_stock.data) if form.original_stock.data else None
+        if form.stock.data != original_stock:
+            unchanged = Product.stock.is_(None) if original_stock is None else Product.stock == original_stock
+            updated = db.session.execute(
+                db.update(Product).where(Product.id == product.id, unchanged)
+                .values(stock=form.stock.data)
+                .execution_options(synchronize_session=False)
+            ).rowcount
+            if not updated:
+                db.session.rollback()
+                current = db.session.get(Product, product_id).stock
+                form.stock.data = current
+                form.original_stock.data = '' if current is None else str(current)
+                flash(f"Stock changed to {'unlimited' if current is None else current} while you were editing. "
+                      f"Nothing was saved, check it and save again.", "warning")
+                form.submit.label.text = "Edit Product"
+                return render_template('add_product.html', form=form, is_edit=True)
+            invalidate_catalog(db.session.connection())
+
         # 1. Update the fields
         product.title = form.title.data
         product.description = form.description.data
 
         if form.image_file.data:
             # Case A: They uploaded a new file
-            upload_result = cloudinary.uploader.upload(form.image_file.data)
-            product.image_url = upload_result.get('secure_url')
+            try:
+                attach_staged_image(product, stage_upload(form.image_file.data))
+            except NotAnImageError:
+                flash("That file doesn't look like an image.","warning")
+                return render_template('add_product.html', form=form, is_edit=True)
         elif form.image_url.data and form.image_url.data != product.image_url:
-            # Case B: They pasted a new URL
+            # Case B: They pasted a new URL (no pipeline variants for it)
             product.image_url = form.image_url.data
+            product.image_key = None
+            product.image_status = None
         
         # 2. Handle Price Conversion (Dollars -> Cents)
         product.price = int(float(form.price.data) * 100)
@@ -813,6 +2925,8 @@ def edit_product(product_id):
     # We manually set the price because the DB has cents (1000), 
     # but the form needs dollars (10.00).
     form.price.data = product.price / 100
+    if not form.is_submitted():
+        form.original_stock.data = '' if product.stock is None else str(product.stock)
     form.submit.label.text="Edit Product"
     # We pass 'is_edit=True' so the template knows to change the title
     return render_template('add_product.html', form=form, is_edit=True)
@@ -821,35 +2935,22 @@ def edit_product(product_id):
 @app.route("/add/<int:product_id>")
 @login_required
 def add_to_cart(product_id): # Accept the ID as an argument
-    if "cart" not in session:
-        session["cart"] = {}
-    
-    cart = session["cart"]
-    product_id_str = str(product_id)
-
-    if product_id_str in cart:
-        cart[product_id_str] += 1
-    else:
-        cart[product_id_str] = 1
-    
-    session["cart"] = cart
+    cart_store.add(current_user.id, product_id)
+    db.session.commit()
     
     return redirect(url_for('home'))
 
-#Go to cart
-@app.route("/cart")
-@login_required
-def view_cart():
-    cart=session.get('cart',{})
+def build_cart(user_id):
+    """Cart lines with product details and the undiscounted total (one IN query)."""
+    cart=cart_store.items(user_id)
     cart_items=[]
     grand_total=0
 
     if cart:
-        product_ids = [int(key) for key in cart.keys() if key and key.isdigit()]
-        products=Product.query.filter(Product.id.in_(product_ids)).all()
+        products=Product.query.filter(Product.id.in_(cart.keys())).all()
 
         for product in products:
-            quantity=cart[str(product.id)]
+            quantity=cart[product.id]
             subtotal=product.price*quantity
             grand_total+=subtotal
 
@@ -860,8 +2961,75 @@ def view_cart():
                 'quantity':quantity,
                 'subtotal':subtotal
             })
+    return cart_items, grand_total
+
+#Go to cart
+@app.route("/cart")
+@login_required
+def view_cart():
+    cart_items, grand_total = build_cart(current_user.id)
     return render_template('cart.html', cart_items=cart_items, grand_total=grand_total)
 
+# --- JSON CART API ---
+# Used by the Add/Remove buttons so one click is one small request instead of a
+# redirect plus a full catalog render. The old GET routes stay as the no-JS path.
+def api_login_required(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if not current_user.is_authenticated:
+            return jsonify(error="Login required"), 401
+        # Cookie-authenticated writes need the CSRF token from the page's <meta> tag
+        if request.method != 'GET':
+            try:
+                validate_csrf(request.headers.get('X-CSRFToken'))
+            except ValidationError:
+                return jsonify(error="Missing or invalid CSRF token"), 400
+        return f(*args, **kwargs)
+    return decorated_function
+
+def cart_summary(user_id):
+    cart_items, grand_total = build_cart(user_id)
+    discount_percent = session.get('coupon_percent', 0)
+    discount = int(grand_total * (discount_percent / 100)) if discount_percent > 0 else 0
+    return jsonify(
+        items=cart_items,
+        count=sum(item['quantity'] for item in cart_items),
+        subtotal=grand_total,
+        discount_percent=discount_percent,
+        discount=discount,
+        total=grand_total - discount,
+    )
+
+@app.route('/api/cart', methods=['GET'])
+@api_login_required
+def api_cart():
+    return cart_summary(current_user.id)
+
+@app.route('/api/cart/items', methods=['POST'])
+@api_login_required
+def api_add_cart_item():
+    data = request.get_json(silent=True) or {}
+    try:
+        product_id = int(data.get('product_id'))
+        quantity = int(data.get('quantity', 1))
+    except (TypeError, ValueError):
+        return jsonify(error="product_id and quantity must be integers"), 400
+    if quantity < 1:
+        return jsonify(error="quantity must be at least 1"), 400
+    if not db.session.get(Product, product_id):
+        return jsonify(error="Product not found"), 404
+
+    cart_store.add(current_user.id, product_id, quantity)
+    db.session.commit()
+    return cart_summary(current_user.id), 201
+
+@app.route('/api/cart/items/<int:product_id>', methods=['DELETE'])
+@api_login_required
+def api_remove_cart_item(product_id):
+    cart_store.remove(current_user.id, product_id)
+    db.session.commit()
+    return cart_summary(current_user.id)
+
 #Delete product for admin only
 @app.route('/delete-product/<int:product_id>')
 @admin_only
@@ -942,20 +3110,42 @@ def delete_coupon(coupon_id):
 @login_required
 def checkout():
     # 1. Get the cart
-    cart = session.get('cart', {})
-    if not cart:
+    quantities = cart_store.items(current_user.id)
+    if not quantities:
         return "Cart is empty", 400
     
-    raw_total = 0
-    # (Do your loop to calculate raw_total first, but DON'T save items yet)
-    # NOTE: You already have a loop in your code. We just need the number first.
-    temp_items = []
-    for p_id, qty in cart.items():
-        if p_id and p_id.isdigit():
-            prod = db.session.get(Product, int(p_id))
-            if prod:
-                raw_total += (prod.price * qty)
-                temp_items.append({'product': prod, 'qty': qty})
+    # 1b. Fetch every product in the cart with ONE IN query
+    #     (FOR UPDATE in ascending ids on Postgres: concurrent checkouts lock the rows
+    #     in the same order, so they queue up instead of deadlocking)
+    products = db.session.execute(
+        db.select(Product).where(Product.id.in_(quantities.keys())).order_by(Product.id).with_for_update()
+    ).scalars().all()
+    raw_total = sum(prod.price * quantities[prod.id] for prod in products)
+
+    short = next((prod for prod in products if prod.stock is not None and prod.stock < quantities[prod.id]), None)
+    if short is not None:
+        title, quantity = short.title, quantities[short.id]
+        db.session.rollback()
+        flash(f"Sorry, we don't have {quantity} of {title} left. Please update your cart.", "warning")
+        return redirect(url_for('view_cart'))
+
+    # 1c. Take every line out of stock in THIS transaction with ONE UPDATE, however
+    #     long the cart. The WHERE makes the decrement atomic, so two workers can never
+    #     both sell the last unit; if any line came up short (someone bought it since
+    #     the read above) the whole checkout rolls back. Unlimited stock stays NULL.
+    if products:
+        wanted = case({prod.id: quantities[prod.id] for prod in products}, value=Product.id)
+        reserved = db.session.execute(
+            db.update(Product)
+            .where(Product.id.in_([prod.id for prod in products]), Product.stock.is_(None) | (Product.stock >= wanted))
+            .values(stock=Product.stock - wanted)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        if reserved != len(products):
+            db.session.rollback()
+            flash("Sorry, part of your cart just sold out. Please update your cart.", "warning")
+            return redirect(url_for('view_cart'))
+
     # --- 2. Apply Discount ---
     discount_percent = session.get('coupon_percent', 0)
     discount_amount = 0
@@ -966,23 +3156,26 @@ def checkout():
     
     final_total = raw_total - discount_amount
 
-    # 2. Create the Order Record (Hardcoded to User #1 for now)
-    new_order = Order(user_id=current_user.id, date=datetime.now().strftime("%Y-%m-%d"), total_price=final_total,discount_amount=discount_amount)
-
+    # 3. Create the Order Record, flush once to get its id
+    new_order = Order(user_id=current_user.id, date=datetime.now(), total_price=final_total,discount_amount=discount_amount)
     db.session.add(new_order)
-    db.session.commit()
+    db.session.flush()
+
+    # 4. Insert every line in one multi-row INSERT
+    order_id = new_order.id
+    if products:
+        db.session.execute(db.insert(OrderItem), [
+            {'order_id': order_id, 'product_id': prod.id,
+             'quantity': quantities[prod.id], 'price_at_purchase': prod.price}
+            for prod in products
+        ])
 
-    for item in temp_items:
-        order_item = OrderItem(
-            order_id=new_order.id,
-            product_id=item['product'].id,
-            quantity=item['qty'],
-            price_at_purchase=item['product'].price
-        )
-        db.session.add(order_item)
-    # We must add the order to the session to generate an ID
-    db.session.commit() # Now new_order.id exists!
-    session.pop('cart', None)
+    # 5. Load the order back with its items and products (two queries, still inside
+    #    the transaction) so the emails and the invoice never lazy-load per line
+    new_order = db.session.execute(
+        db.select(Order).options(*Order.detail_loads()).where(Order.id == order_id)
+    ).scalar_one()
+    cart_store.clear(current_user.id)
     session.pop('coupon_code', None)
     session.pop('coupon_percent', None)
     safe_email = current_user.email
@@ -997,14 +3190,38 @@ def checkout():
 
     try:
         send_order_confirmation_email_pdf(safe_email,safe_name, current_user,new_order)
-        flash("PDF Invoice has been sent successfully","success")
+        flash("Your PDF invoice is being prepared and will be emailed shortly","success")
     except Exception as e:
         # Don't crash the app if email fails (e.g., wifi blip)
         flash(f"Pdf Invoice failed to send: {e}","warning")
 
+    # 6. ONE commit: the order, its items, its queued emails and the sales rollup land together
+    record_daily_sales(new_order.date, new_order.total_price, 1)
+    invalidate_pending_count()
+    db.session.commit()
     
     flash('Order placed successfully! Check your email for the receipt.', 'success')
-    return render_template('success.html', order_id=new_order.id)
+    return render_template('success.html', order_id=order_id)
+
+@app.route('/order/<int:order_id>/invoice.pdf')
+@login_required
+def order_invoice(order_id):
+    order = db.get_or_404(Order, order_id)
+
+    # Customers can only download their own invoices, the admin can see all
+    if order.user_id != current_user.id and current_user.id != 1:
+        return abort(403)
+
+    path = invoice_path(order.id)
+    if os.path.exists(path):
+        return send_file(path, mimetype='application/pdf', download_name=f"Invoice_{order.id}.pdf")
+
+    # Not cached yet (old order, failed render, or still rendering elsewhere)
+    if order.id not in invoice_pool.in_flight:
+        request_invoice(order, order.customer)
+        db.session.commit()
+    flash("Your invoice is being generated, please try again in a few seconds.", "info")
+    return redirect(request.referrer or url_for('my_orders'))
 
 @app.route("/product/<int:product_id>/add_image", methods=["POST"])
 @admin_only
@@ -1019,22 +3236,53 @@ def add_product_image(product_id):
     
     if file and file.filename != "":
         try:
-            upload_result = cloudinary.uploader.upload(file)
-            image_url = upload_result['secure_url']
-            
-            # 3. SAVE URL TO DB
-            new_image = ProductImage(image_url=image_url, product=product)
+            # 3. SAVE TO DB with a placeholder, the upload worker fills in the real URL
+            new_image = ProductImage(product=product)
             db.session.add(new_image)
+            attach_staged_image(new_image, stage_upload(file))
             db.session.commit()
-            flash("Extra image uploaded successfully!", "success")
+            flash("Extra image uploaded, it will show up in a few seconds.", "success")
             
         except Exception as e:
+            db.session.rollback()
             flash(f"Upload failed: {e}", "danger")
     else:
         flash("No file selected.", "warning")
     
     return redirect(url_for('product_detail', product_id=product.id))
 
+@app.route("/product/<int:product_id>/images", methods=["POST"])
+@admin_only
+def add_product_images(product_id):
+    # Bulk version of add_product_image: many files in one request, one commit
+    product = db.get_or_404(Product, product_id)
+    files = [f for f in request.files.getlist('files') if f and f.filename]
+    if not files:
+        flash("No files selected.", "warning")
+        return redirect(url_for('product_detail', product_id=product.id))
+    if len(files) > MAX_GALLERY_UPLOAD:
+        flash(f"Please upload at most {MAX_GALLERY_UPLOAD} images at a time.", "warning")
+        return redirect(url_for('product_detail', product_id=product.id))
+
+    rejected = []
+    for file in files:
+        try:
+            key = stage_upload(file)
+        except NotAnImageError:
+            rejected.append(file.filename)
+            continue
+        new_image = ProductImage(product=product)
+        db.session.add(new_image)
+        attach_staged_image(new_image, key)
+    db.session.commit()
+
+    accepted = len(files) - len(rejected)
+    if accepted:
+        flash(f"{accepted} image(s) uploaded, they will show up in a few seconds.", "success")
+    if rejected:
+        flash(f"Skipped (not images): {', '.join(rejected)}", "warning")
+    return redirect(url_for('product_detail', product_id=product.id))
+
 @app.route("/delete_image/<int:image_id>")
 @admin_only
 def delete_product_image(image_id):
@@ -1051,13 +3299,8 @@ def delete_product_image(image_id):
 @app.route('/remove/<int:product_id>')
 @login_required
 def remove_from_cart(product_id):
-    cart = session.get('cart', {})
-    
-    product_id_str = str(product_id)
-    
-    cart.pop(product_id_str, None)
-    
-    session['cart'] = cart
+    cart_store.remove(current_user.id, product_id)
+    db.session.commit()
     
     return redirect(url_for('view_cart'))
 
@@ -1101,6 +3344,7 @@ def reset_request():
         
         if user:
             send_reset_email(user)
+            db.session.commit()
             
         flash('If an account with that email exists, an email has been sent with instructions.', 'info')
         return redirect(url_for('login'))
@@ -1147,53 +3391,87 @@ def reset_token(token):
     return render_template('reset_token.html')
 
 
+CSV_BATCH_SIZE = 1000
+
 @app.route('/admin/export_csv')
 @admin_only
+@read_replica
 def export_csv():
-    # 1. Query all orders
-    orders = Order.query.order_by(Order.id.desc()).all()
-    
-    # 2. Setup CSV
-    si = io.StringIO()
-    cw = csv.writer(si)
-    cw.writerow(['Order ID', 'Date', 'Customer Name', 'Email', 'Items', 'Total Price ($)', 'Status'])
-    
-    # 3. Loop through orders
-    for order in orders:
-        # A. Format Items (Safe Check)
-        items_list = []
-        for item in order.items:
-            p_title = item.product.title if item.product else "Deleted Product"
-            items_list.append(f"{p_title} (x{item.quantity})")
-        items_str = "; ".join(items_list)
-        
-        # B. Handle Ghost Users (Safe Check)
-        if order.customer:
-            c_name = order.customer.name
-            c_email = order.customer.email
-        else:
-            c_name = "Deleted User"
-            c_email = "N/A"
-
-        # C. Handle Ghost Dates (THE FIX)
-        # If order.date is empty, print "Unknown Date" instead of blank
-        date_str = order.date if order.date else "Unknown Date"
-
-        # D. Write Row
-        cw.writerow([
-            order.id,
-            date_str,     # <--- Uses the safe variable
-            c_name,
-            c_email,
-            items_str,
-            "%.2f" % (order.total_price / 100),
-            order.status  # <--- Changed "Paid" to actual status (Pending/Shipped)
-        ])
-        
-    # 4. Return File
-    output = make_response(si.getvalue())
-    output.headers["Content-Disposition"] = "attachment; filename=orders_export.csv"
-    output.headers["Content-type"] = "text/csv"
+    # Optional filters: ?start=2025-01-01&end=2025-01-31&status=Pending&gzip=1
+    start = request.args.get('start', '')
+    end = request.args.get('end', '')
+    status = request.args.get('status', '')
+    use_gzip = request.args.get('gzip') == '1'
+
+    # 1. Build the query (customer, items and products eager-loaded per batch)
+    stmt = db.select(Order).options(*Order.detail_loads()).order_by(Order.id.desc())
+    stmt = filter_by_day_range(stmt, Order.date, start, end)
+    if status:
+        stmt = stmt.where(Order.status == status)
+    # yield_per streams from a server-side cursor instead of fetching everything
+    stmt = stmt.execution_options(yield_per=CSV_BATCH_SIZE)
+
+    def generate_rows():
+        # 2. Setup CSV (one small buffer, emptied after every batch)
+        si = io.StringIO()
+        cw = csv.writer(si)
+        cw.writerow(['Order ID', 'Date', 'Customer Name', 'Email', 'Items', 'Total Price ($)', 'Status'])
+
+        # 3. Loop through orders, one batch at a time
+        for batch in db.session.execute(stmt).scalars().partitions():
+            for order in batch:
+                # A. Format Items (Safe Check)
+                items_list = []
+                for item in order.items:
+                    p_title = item.product.title if item.product else "Deleted Product"
+                    items_list.append(f"{p_title} (x{item.quantity})")
+                items_str = "; ".join(items_list)
+
+                # B. Handle Ghost Users (Safe Check)
+                if order.customer:
+                    c_name = order.customer.name
+                    c_email = order.customer.email
+                else:
+                    c_name = "Deleted User"
+                    c_email = "N/A"
+
+                # C. Handle Ghost Dates (THE FIX)
+                # If order.date is empty, print "Unknown Date" instead of blank
+                date_str = order.date.strftime('%Y-%m-%d %H:%M') if order.date else "Unknown Date"
+
+                # D. Write Row
+                cw.writerow([
+                    order.id,
+                    date_str,     # <--- Uses the safe variable
+                    c_name,
+                    c_email,
+                    items_str,
+                    "%.2f" % (order.total_price / 100),
+                    order.status  # <--- Changed "Paid" to actual status (Pending/Shipped)
+                ])
+
+            # E. Send this batch and forget it. The session only holds weak references,
+            #    so finished orders are garbage collected and memory stays flat
+            yield si.getvalue()
+            si.seek(0)
+            si.truncate(0)
+        if si.tell():
+            yield si.getvalue()
+
+    def generate_gzip():
+        # wbits=31 -> gzip container, compressed incrementally batch by batch
+        compressor = zlib.compressobj(wbits=31)
+        for chunk in generate_rows():
+            data = compressor.compress(chunk.encode('utf-8'))
+            if data:
+                yield data
+        yield compressor.flush()
+
+    # 4. Return a streamed file
+    filename = "orders_export.csv.gz" if use_gzip else "orders_export.csv"
+    body = generate_gzip() if use_gzip else generate_rows()
+    output = Response(stream_with_context(body), mimetype="application/gzip" if use_gzip else "text/csv")
+    output.headers["Content-Disposition"] = f"attachment; filename={filename}"
     return output
 
 @app.route('/order/cancel/<int:order_id>')
@@ -1222,12 +3500,30 @@ def cancel_order(order_id):
 
     # 3. Soft Cancel (Update Status instead of Delete)
     try:
-        order.status = "Cancelled"
-        db.session.commit()
+        # Conditional, so a double-click can't cancel (and restock) the same order twice
+        cancelled = db.session.execute(
+            db.update(Order).where(Order.id == order.id, Order.status.not_in(['Shipped', 'Cancelled']))
+            .values(status='Cancelled')
+        ).rowcount
+        if not cancelled:
+            db.session.rollback()
+            flash("This order can no longer be cancelled.", "info")
+            return redirect(url_for('my_orders'))
+        # Put the units back (unlimited products stay NULL)
+        for item in order.items:
+            db.session.execute(
+                db.update(Product).where(Product.id == item.product_id)
+                .values(stock=Product.stock + item.quantity)
+                .execution_options(synchronize_session=False)
+            )
+        invalidate_pending_count()
+        if order.date:
+            record_daily_sales(order.date, -order.total_price, -1)
         
-        # 4. Send Email
+        # 4. Send Email (queued in the same transaction as the status change)
         # (Pass the refund amount so the email knows what to say)
         send_cancel_email(current_user, order.id, order.total_price)
+        db.session.commit()
         
         flash(f"Order #{order.id} has been cancelled.", "success")
         
@@ -0,0 +1,147 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+from time import perf_counter
+
+# Hundreds of shoppers hit /checkout at the same moment, from several processes (like
+# gunicorn workers), for a product with only a few units left. Every cart also holds an
+# unlimited product, so a checkout that comes up short must roll back BOTH lines.
+# Exits 1 if the product is ever oversold or an order is left half-written.
+#
+#   python stress_checkout.py
+#   python stress_checkout.py --shoppers 500 --stock 3 --workers 8
+#   python stress_checkout.py --db-uri postgresql://localhost/fakeshop_stress   (an empty scratch database)
+
+STRESS_DIR = os.path.join(tempfile.gettempdir(), 'stress_checkout')
+LIMITED, UNLIMITED = 1, 2  # product ids
+
+def worker_env(db_uri):
+    return dict(os.environ, DB_URI=db_uri, MAIL_WORKERS='0', INVOICE_PROCESSES='1', UPLOAD_WORKERS='0',
+                INVOICE_DIR=os.path.join(STRESS_DIR, 'invoices'), SQLITE_BUSY_TIMEOUT_MS='60000')
+
+def run_seed(shoppers, stock):
+    from server import app, db, cart_store, Product, User, migrate_database
+    with app.app_context():
+        migrate_database()
+        db.session.add_all([
+            Product(id=LIMITED, title='Last Few Sneakers', price=5000, description='Low stock', image_url='https://example.com/s.jpg', stock=stock),
+            Product(id=UNLIMITED, title='Socks', price=500, description='Plenty', image_url='https://example.com/k.jpg'),
+        ])
+        db.session.execute(db.insert(User), [
+            {'id': i, 'name': f'Shopper {i}', 'email': f'shopper{i}@example.com', 'password': 'x'}
+            for i in range(2, shoppers + 2)  # user 1 is the admin
+        ])
+        db.session.commit()
+        for user_id in range(2, shoppers + 2):
+            cart_store.add(user_id, LIMITED)
+            cart_store.add(user_id, UNLIMITED)
+        db.session.commit()
+
+def run_worker(user_ids):
+    from server import app
+    results = {'sold': 0, 'short': 0, 'errors': 0}
+    lock = threading.Lock()
+    start = threading.Barrier(len(user_ids))
+
+    def shop(user_id):
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess['_user_id'] = str(user_id)  # logged in, without paying for a password hash
+            sess['_fresh'] = True
+        start.wait()
+        response = client.get('/checkout')
+        outcome = 'sold' if response.status_code == 200 else 'short' if response.status_code == 302 else 'errors'
+        with lock:
+            results[outcome] += 1
+
+    threads = [threading.Thread(target=shop, args=(user_id,)) for user_id in user_ids]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    print(json.dumps(results))
+
+def check(stock, sold):
+    from server import app, db, func, Order, OrderItem, Product
+    with app.app_context():
+        left = db.session.get(Product, LIMITED).stock
+        units = db.session.execute(
+            db.select(func.coalesce(func.sum(OrderItem.quantity), 0)).where(OrderItem.product_id == LIMITED)
+        ).scalar()
+        orders = db.session.execute(db.select(func.count(Order.id))).scalar()
+        # Every order must have both of its lines (a short checkout leaves nothing behind)
+        half_written = db.session.execute(
+            db.select(func.count()).select_from(
+                db.select(OrderItem.order_id).group_by(OrderItem.order_id).having(func.count() != 2).subquery()
+            )
+        ).scalar()
+    problems = []
+    if left < 0 or units > stock:
+        problems.append(f"oversold: {units} units sold of {stock}, stock now {left}")
+    if units + left != stock:
+        problems.append(f"units sold ({units}) + stock left ({left}) != starting stock ({stock})")
+    if orders != sold or units != sold:
+        problems.append(f"{sold} checkouts succeeded but found {orders} orders / {units} units")
+    if half_written:
+        problems.append(f"{half_written} orders are missing a line")
+    return left, problems
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent checkouts against a low-stock product.")
+    parser.add_argument('--shoppers', type=int, default=300)
+    parser.add_argument('--stock', type=int, default=5)
+    parser.add_argument('--workers', type=int, default=4, help='Processes, each firing its shoppers from threads.')
+    parser.add_argument('--db-uri', help='Defaults to a fresh SQLite file in the temp dir.')
+    args = parser.parse_args()
+
+    os.makedirs(STRESS_DIR, exist_ok=True)
+    db_uri = args.db_uri
+    if not db_uri:
+        db_path = os.path.join(STRESS_DIR, 'stress.db')
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(db_path + suffix):
+                os.remove(db_path + suffix)
+        db_uri = f"sqlite:///{db_path}"
+    env = worker_env(db_uri)
+
+    print(f"Seeding {args.shoppers} shoppers, stock {args.stock}...")
+    subprocess.run([sys.executable, __file__, '--seed', str(args.shoppers), str(args.stock)], env=env, check=True,
+                   stdout=subprocess.DEVNULL)
+
+    user_ids = list(range(2, args.shoppers + 2))
+    slices = [user_ids[i::args.workers] for i in range(args.workers)]
+    began = perf_counter()
+    procs = [
+        subprocess.Popen([sys.executable, __file__, '--worker', ','.join(map(str, ids))], env=env,
+                         stdout=subprocess.PIPE, text=True)
+        for ids in slices if ids
+    ]
+    results = [json.loads(proc.communicate()[0].strip().splitlines()[-1]) for proc in procs]
+    sold = sum(r['sold'] for r in results)
+    short = sum(r['short'] for r in results)
+    errors = sum(r['errors'] for r in results)
+    print(f"{args.shoppers} checkouts in {perf_counter() - began:.1f}s from {len(procs)} processes: "
+          f"{sold} sold, {short} turned away, {errors} errors")
+
+    os.environ.update(env)
+    left, problems = check(args.stock, sold)
+    if errors:
+        problems.append(f"{errors} checkouts failed with an error")
+    if problems:
+        for problem in problems:
+            print(f"❌ {problem}")
+        return 1
+    print(f"✅ Never oversold: {sold} of {args.stock} units sold, {left} left.")
+    return 0
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ['--seed']:
+        run_seed(int(sys.argv[2]), int(sys.argv[3]))
+    elif sys.argv[1:2] == ['--worker']:
+        run_worker([int(user_id) for user_id in sys.argv[2].split(',')])
+    else:
+        raise SystemExit(main())
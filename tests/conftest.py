@@ -0,0 +1,79 @@
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+from itertools import count
+
+import pytest
+from sqlalchemy import event
+
+# server.py reads its settings at import time, so point it at a scratch database
+# (never instance/Product.db) before anything imports it
+TEST_DIR = tempfile.mkdtemp(prefix='fakeshop_tests_')
+os.environ.update(
+    DB_URI=f"sqlite:///{os.path.join(TEST_DIR, 'test.db')}",
+    EMAIL_USER='shop@example.com', MAIL_WORKERS='0', INVOICE_PROCESSES='1', UPLOAD_WORKERS='0',
+    INVOICE_DIR=os.path.join(TEST_DIR, 'invoices'), IMAGE_DIR=os.path.join(TEST_DIR, 'images'),
+    UPLOAD_STAGING_DIR=os.path.join(TEST_DIR, 'staging'),
+)
+
+ids = count(1)
+
+@pytest.fixture(scope='session')
+def app():
+    from server import app, db, User, migrate_database
+    app.config.update(TESTING=True, WTF_CSRF_ENABLED=False)
+    with app.app_context():
+        migrate_database()
+        db.session.add(User(id=1, name='Admin', email='admin@example.com', password='x'))  # user 1 is the admin
+        db.session.commit()
+    return app
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+def login(client, user_id):
+    with client.session_transaction() as sess:
+        sess['_user_id'] = str(user_id)  # logged in, without paying for a password hash
+        sess['_fresh'] = True
+
+def make_user(app):
+    from server import db, User
+    n = next(ids)
+    with app.app_context():
+        user = User(name=f'Shopper {n}', email=f'shopper{n}@example.com', password='x')
+        db.session.add(user)
+        db.session.commit()
+        return user.id
+
+def make_products(app, n, stock=None):
+    from server import db, Product
+    with app.app_context():
+        products = [
+            Product(title=f'Product {next(ids)}', price=1000, description='Test product',
+                    image_url='https://example.com/p.jpg', stock=stock)
+            for _ in range(n)
+        ]
+        db.session.add_all(products)
+        db.session.commit()
+        return [product.id for product in products]
+
+@contextmanager
+def count_statements(app):
+    """Counts the SQL statements issued on THIS thread (not the background flushers)."""
+    from server import db
+    statements = []
+    thread = threading.get_ident()
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if threading.get_ident() == thread:
+            statements.append(statement)
+
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
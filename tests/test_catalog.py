@@ -0,0 +1,51 @@
+from conftest import login
+
+def product(app, **fields):
+    from server import db, Product
+    with app.app_context():
+        row = Product(price=1000, description='Test product', image_url='https://example.com/p.jpg', **fields)
+        db.session.add(row)
+        db.session.commit()
+        return row.id
+
+def sku_of(app, product_id):
+    from server import db, Product
+    with app.app_context():
+        return db.session.get(Product, product_id).sku
+
+def test_export_only_reads(app, tmp_path):
+    # A site product without a SKU, and an imported one already holding its default 'FS-<id>'
+    site_id = product(app, title='Made on the site')
+    product(app, title='Imported', sku=f'FS-{site_id}')
+
+    result = app.test_cli_runner().invoke(args=['catalog', 'export', str(tmp_path / 'out.csv')])
+    assert result.exit_code == 0, result.output
+    assert 'have no SKU' in result.output
+    assert sku_of(app, site_id) is None
+
+def test_import_assigns_missing_skus_around_collisions(app, tmp_path):
+    site_id = product(app, title='Made on the site too')
+    product(app, title='Imported too', sku=f'FS-{site_id}')
+    catalog = tmp_path / 'in.csv'
+    catalog.write_text('sku,title,price,description,image_url\n'
+                       'DUP-1,First,100,d,https://example.com/a.jpg\n'
+                       'DUP-1,Second,200,d,https://example.com/b.jpg\n'
+                       'ONE-1,Other,300,d,https://example.com/c.jpg\n')
+
+    result = app.test_cli_runner().invoke(args=['catalog', 'import', str(catalog)])
+    assert result.exit_code == 0, result.output
+    assert 'Imported 2 products' in result.output
+    assert '1 repeated SKUs' in result.output
+    assert sku_of(app, site_id) == f'FS-{site_id}-2'
+
+def test_admin_form_products_get_a_sku(app, client):
+    from server import db, Product
+    login(client, 1)
+    response = client.post('/add_product', data={
+        'title': 'Form product', 'price': '10.00', 'description': 'Test product',
+        'image_url': 'https://example.com/p.jpg',
+    })
+    assert response.status_code == 302
+    with app.app_context():
+        row = db.session.execute(db.select(Product).where(Product.title == 'Form product')).scalar_one()
+        assert row.sku == f'FS-{row.id}'
@@ -0,0 +1,54 @@
+import pytest
+
+from conftest import login, make_user, make_products, count_statements
+
+def fill_cart(app, user_id, product_ids, quantity=1):
+    from server import db, cart_store
+    with app.app_context():
+        for product_id in product_ids:
+            cart_store.add(user_id, product_id, quantity)
+        db.session.commit()
+
+def checkout_statements(app, client, lines, stock=None):
+    user_id = make_user(app)
+    fill_cart(app, user_id, make_products(app, lines, stock=stock))
+    login(client, user_id)
+    with count_statements(app) as statements:
+        response = client.get('/checkout')
+    assert response.status_code == 200
+    return len(statements)
+
+def test_checkout_statements_do_not_grow_with_the_cart(app, client):
+    one = checkout_statements(app, client, 1)
+    assert checkout_statements(app, client, 5) == one
+    assert checkout_statements(app, client, 20) == one
+
+@pytest.mark.parametrize('stock', [None, 10])
+def test_checkout_takes_stock_with_one_update(app, client, stock):
+    one = checkout_statements(app, client, 1, stock=stock)
+    assert checkout_statements(app, client, 20, stock=stock) == one
+
+def test_checkout_decrements_every_limited_line(app, client):
+    from server import db, Product, Order
+    user_id = make_user(app)
+    limited, other_limited, unlimited = make_products(app, 2, stock=5) + make_products(app, 1)
+    fill_cart(app, user_id, [limited, other_limited, unlimited], quantity=2)
+    login(client, user_id)
+
+    assert client.get('/checkout').status_code == 200
+    with app.app_context():
+        assert [db.session.get(Product, i).stock for i in (limited, other_limited, unlimited)] == [3, 3, None]
+        assert db.session.execute(db.select(Order).where(Order.user_id == user_id)).scalar_one().total_price == 6000
+
+def test_short_line_rolls_back_the_whole_checkout(app, client):
+    from server import db, Product, Order
+    user_id = make_user(app)
+    plenty, last_one = make_products(app, 1, stock=5) + make_products(app, 1, stock=1)
+    fill_cart(app, user_id, [plenty, last_one], quantity=2)
+    login(client, user_id)
+
+    response = client.get('/checkout')
+    assert response.status_code == 302
+    with app.app_context():
+        assert [db.session.get(Product, i).stock for i in (plenty, last_one)] == [5, 1]
+        assert db.session.execute(db.select(Order).where(Order.user_id == user_id)).first() is None
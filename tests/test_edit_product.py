@@ -0,0 +1,61 @@
+import re
+
+from conftest import login, make_products
+
+def edit_form(client, product_id):
+    """The edit page's hidden original_stock, like the browser would post it back."""
+    page = client.get(f'/edit-product/{product_id}').get_data(as_text=True)
+    return re.search(r'name="original_stock" type="hidden" value="([^"]*)"', page).group(1)
+
+def post_edit(client, product_id, stock, original_stock, title='Edited'):
+    return client.post(f'/edit-product/{product_id}', data={
+        'title': title, 'price': '10.00', 'description': 'Test product',
+        'image_url': 'https://example.com/p.jpg', 'stock': stock, 'original_stock': original_stock,
+    })
+
+def stock_of(app, product_id):
+    from server import db, Product
+    with app.app_context():
+        return db.session.get(Product, product_id).stock
+
+def sell(app, product_id, units):
+    from server import db, Product
+    with app.app_context():
+        db.session.execute(db.update(Product).where(Product.id == product_id).values(stock=Product.stock - units))
+        db.session.commit()
+
+def test_saving_other_fields_keeps_sales_made_meanwhile(app, client):
+    product_id, = make_products(app, 1, stock=10)
+    login(client, 1)
+    original = edit_form(client, product_id)
+    assert original == '10'
+
+    sell(app, product_id, 3)  # checkouts while the form is open
+    assert post_edit(client, product_id, '10', original).status_code == 302
+    assert stock_of(app, product_id) == 7
+
+def test_restock_is_a_compare_and_set(app, client):
+    product_id, = make_products(app, 1, stock=10)
+    login(client, 1)
+    original = edit_form(client, product_id)
+
+    assert post_edit(client, product_id, '50', original).status_code == 302
+    assert stock_of(app, product_id) == 50
+
+    # A second tab still showing 10: refused, and the form comes back with the real value
+    response = post_edit(client, product_id, '20', original, title='Stale tab')
+    assert response.status_code == 200
+    assert 'Stock changed to 50' in response.get_data(as_text=True)
+    assert stock_of(app, product_id) == 50
+    from server import db, Product
+    with app.app_context():
+        assert db.session.get(Product, product_id).title == 'Edited'
+
+def test_unlimited_stock(app, client):
+    product_id, = make_products(app, 1)
+    login(client, 1)
+    original = edit_form(client, product_id)
+    assert original == ''
+
+    assert post_edit(client, product_id, '5', original).status_code == 302
+    assert stock_of(app, product_id) == 5
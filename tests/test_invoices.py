@@ -0,0 +1,52 @@
+import os
+
+from conftest import login, make_user, make_products
+from test_checkout import fill_cart
+
+def place_order(app, client):
+    from server import db, Order
+    user_id = make_user(app)
+    login(client, user_id)
+    fill_cart(app, user_id, make_products(app, 2))
+    assert client.get('/checkout').status_code == 200
+    with app.app_context():
+        return db.session.execute(db.select(Order.id).where(Order.user_id == user_id)).scalar_one()
+
+def invoice_status(app, order_id):
+    from server import db, Order
+    with app.app_context():
+        return db.session.get(Order, order_id).invoice_status
+
+def test_zero_processes_renders_inline(app, client, monkeypatch):
+    import server
+    pool = server.InvoicePool(0)
+    monkeypatch.setattr(server, 'invoice_pool', pool)
+
+    order_id = place_order(app, client)
+    assert invoice_status(app, order_id) == 'ready'
+    assert os.path.exists(server.invoice_path(order_id))
+    assert pool.in_flight == set()
+
+    response = client.get(f'/order/{order_id}/invoice.pdf')
+    assert response.status_code == 200
+    assert response.data.startswith(b'%PDF')
+
+def test_failed_submit_is_retried_by_the_next_download(app, client, monkeypatch):
+    import server
+    pool = server.InvoicePool(1)
+    monkeypatch.setattr(server, 'invoice_pool', pool)
+
+    def no_processes(*args, **kwargs):
+        raise ValueError("max_workers must be greater than 0")
+    with monkeypatch.context() as patch:
+        patch.setattr(server, 'ProcessPoolExecutor', no_processes)
+        order_id = place_order(app, client)
+    assert invoice_status(app, order_id) == 'failed'
+    assert order_id not in pool.in_flight
+
+    # The download page resubmits it instead of saying "being generated" forever
+    monkeypatch.setattr(server, 'invoice_pool', server.InvoicePool(0))
+    response = client.get(f'/order/{order_id}/invoice.pdf')
+    assert response.status_code == 302
+    assert invoice_status(app, order_id) == 'ready'
+    assert client.get(f'/order/{order_id}/invoice.pdf').status_code == 200
@@ -0,0 +1,71 @@
+import socket
+import time
+
+import pytest
+from aiosmtpd.controller import Controller  # requirements-dev.txt
+
+from conftest import login, make_user, make_products
+from test_checkout import fill_cart
+
+class Inbox:
+    def __init__(self):
+        self.messages = []
+
+    async def handle_DATA(self, server, session, envelope):
+        self.messages.append(envelope)
+        return '250 OK'
+
+@pytest.fixture
+def smtp(app, monkeypatch):
+    """A real SMTP server on localhost, with the app's Flask-Mail pointed at it."""
+    inbox = Inbox()
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    controller = Controller(inbox, hostname='127.0.0.1', port=port)
+    controller.start()
+    state = app.extensions['mail']
+    for name, value in {'server': '127.0.0.1', 'port': port, 'use_tls': False, 'use_ssl': False,
+                        'username': None, 'password': None, 'suppress': False}.items():
+        monkeypatch.setattr(state, name, value)
+    yield inbox
+    controller.stop()
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+def test_sender_threads_start_with_the_first_request(app, client, smtp, monkeypatch):
+    import server
+    from server import db, OutboxEmail, EmailWorkerPool
+
+    # Queued while no worker in this process sends (MAIL_WORKERS=0)...
+    user_id = make_user(app)
+    login(client, user_id)
+    fill_cart(app, user_id, make_products(app, 1))
+    assert client.get('/checkout').status_code == 200
+    with app.app_context():
+        email = db.session.get(server.User, user_id).email
+
+    def queued(*statuses):
+        with app.app_context():
+            return db.session.execute(
+                db.select(db.func.count()).select_from(OutboxEmail)
+                .where(OutboxEmail.recipients.contains(email), OutboxEmail.status.in_(statuses))
+            ).scalar()
+
+    # (the order confirmation, and the invoice once its PDF is rendered)
+    assert wait_for(lambda: queued('pending') == 2)
+
+    # ...then a worker with sender threads boots and only serves a page
+    pool = EmailWorkerPool(1, poll_seconds=60)
+    monkeypatch.setattr(server, 'email_pool', pool)
+    assert client.get('/').status_code == 200
+    assert pool.pid is not None
+
+    assert wait_for(lambda: queued('sent') == 2)
+    assert len([envelope for envelope in smtp.messages if email in envelope.rcpt_tos]) == 2
@@ -0,0 +1,17 @@
+import pytest
+
+@pytest.fixture(scope='module')
+def running_shoe(app):
+    from server import db, Product
+    with app.app_context():
+        db.session.add(Product(title='Running Shoe', price=5000, description='Fast runners only',
+                               image_url='https://example.com/s.jpg'))
+        db.session.commit()
+
+@pytest.mark.parametrize('query', ['runn', 'running', 'run sho', 'ru', 'RUNNING shoe'])
+def test_partial_words_match(client, running_shoe, query):
+    # Every token is a prefix query, so the index must not stem "running" to "run"
+    assert 'Running Shoe' in client.get('/', query_string={'q': query}).get_data(as_text=True)
+
+def test_every_token_is_required(client, running_shoe):
+    assert 'Running Shoe' not in client.get('/', query_string={'q': 'running sandal'}).get_data(as_text=True)
@@ -0,0 +1,51 @@
+import gzip
+
+import pytest
+
+from conftest import login, make_user, make_products
+from test_checkout import fill_cart
+
+# With STRICT_QUERIES on, a relationship the view did not load up front raises
+# instead of lazy-loading, and going over a @query_budget raises too. These
+# pages walk every order's customer, items and products.
+
+@pytest.fixture
+def strict(app, monkeypatch):
+    monkeypatch.setitem(app.config, 'STRICT_QUERIES', True)
+
+@pytest.fixture
+def orders(app, client):
+    """A customer with two orders of several lines each, placed through /checkout."""
+    user_id = make_user(app)
+    login(client, user_id)
+    for lines in (3, 2):
+        fill_cart(app, user_id, make_products(app, lines))
+        assert client.get('/checkout').status_code == 200
+    return user_id
+
+def test_admin_orders(app, client, orders, strict):
+    login(client, 1)
+    response = client.get('/admin/orders')
+    assert response.status_code == 200
+    assert 'shopper' in response.get_data(as_text=True)
+
+    response = client.get('/admin/orders?status=Pending')
+    assert response.status_code == 200
+
+def test_my_orders(app, client, orders, strict):
+    response = client.get('/my-orders')
+    assert response.status_code == 200
+    assert 'Product' in response.get_data(as_text=True)
+
+@pytest.mark.parametrize('compressed', [False, True])
+def test_export_csv(app, client, orders, strict, compressed):
+    login(client, 1)
+    response = client.get('/admin/export_csv' + ('?gzip=1' if compressed else ''))
+    assert response.status_code == 200
+    body = response.get_data()
+    if compressed:
+        body = gzip.decompress(body)
+    rows = body.decode().splitlines()
+    assert rows[0].startswith('Order ID')
+    assert len(rows) >= 3
+    assert '(x1)' in rows[1]
@@ -0,0 +1,82 @@
+import os
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+from conftest import login, make_products
+
+def png_bytes():
+    buffer = BytesIO()
+    Image.frombytes('RGB', (64, 48), os.urandom(64 * 48 * 3)).save(buffer, 'PNG')  # noise: several KB of IDAT
+    return buffer.getvalue()
+
+def truncated_png():
+    data = png_bytes()
+    return data[:len(data) // 2]  # verify() raises OSError "Truncated File Read"
+
+def corrupted_png():
+    data = bytearray(png_bytes())
+    data[len(data) // 2] ^= 0xff  # verify() raises SyntaxError (bad chunk checksum)
+    return bytes(data)
+
+def add_product(client, title, data):
+    return client.post('/add_product', content_type='multipart/form-data', data={
+        'title': title, 'price': '10.00', 'description': 'Test product',
+        'image_file': (BytesIO(data), 'photo.png'),
+    })
+
+def product_by_title(app, title):
+    from server import db, Product
+    with app.app_context():
+        return db.session.execute(db.select(Product).where(Product.title == title)).scalar_one_or_none()
+
+@pytest.fixture
+def storage(monkeypatch):
+    import server
+    storage = server.MemoryImageStorage()
+    monkeypatch.setattr(server, 'image_storage', storage)
+    monkeypatch.setattr(server, 'UPLOAD_BACKOFF_SECONDS', 0)
+    return storage
+
+@pytest.mark.parametrize('make_data', [truncated_png, corrupted_png, lambda: b'not an image at all'])
+def test_corrupt_upload_is_rejected(app, client, storage, make_data):
+    login(client, 1)
+    title = f'Corrupt {make_data.__name__}'
+    response = add_product(client, title, make_data())
+    assert response.status_code == 200
+    assert "doesn&#39;t look like an image" in response.get_data(as_text=True)
+    assert product_by_title(app, title) is None
+
+def test_corrupt_file_does_not_abort_a_gallery_upload(app, client, storage):
+    from server import db, ProductImage
+    product_id, = make_products(app, 1)
+    login(client, 1)
+    response = client.post(f'/product/{product_id}/images', content_type='multipart/form-data', data={
+        'files': [(BytesIO(truncated_png()), 'broken.png'), (BytesIO(png_bytes()), 'good.png')],
+    })
+    assert response.status_code == 302
+    with app.app_context():
+        images = db.session.execute(db.select(ProductImage).where(ProductImage.product_id == product_id)).scalars().all()
+        assert [image.image_status for image in images] == [None]
+
+def test_upload_retries_a_flaky_storage_backend(app, client, storage):
+    storage.fail_next = 2  # the first two attempts hit an "outage"
+    login(client, 1)
+    assert add_product(client, 'Flaky storage', png_bytes()).status_code == 302
+
+    product = product_by_title(app, 'Flaky storage')
+    assert product.image_status is None
+    assert product.image_url == f'memory://products/{product.image_key}/detail.jpg'
+    assert len(storage.files) == 6  # 3 widths x JPEG/WebP
+
+def test_upload_gives_up_after_max_attempts(app, client, storage):
+    import server
+    storage.fail_next = server.UPLOAD_MAX_ATTEMPTS
+    login(client, 1)
+    assert add_product(client, 'Storage down', png_bytes()).status_code == 302
+
+    product = product_by_title(app, 'Storage down')
+    assert product.image_status == 'failed'
+    assert product.image_url == server.IMAGE_PLACEHOLDER
+    assert storage.files == {}